@@ -0,0 +1,7 @@
+"""Hybrid real estate price prediction pipeline.
+
+The pipeline is split into stages that can be imported and run on their own:
+``extract``, ``preprocess``, ``train``, ``evaluate`` and ``report``. Heavy
+dependencies (torch, open_clip, xgboost, matplotlib) are only imported by the
+stage that needs them, so nothing is loaded here.
+"""
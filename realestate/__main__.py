@@ -0,0 +1,213 @@
+"""Command line entry point: ``python -m realestate run [--headless]``, ``extract-shard``, ``predict``, ``refresh`` and ``serve``."""
+
+import argparse
+import time
+import warnings
+
+STAGES = ["extract", "preprocess", "train", "evaluate", "report"]
+
+# Mirrors extract.CLIP_BACKENDS without importing torch to parse the arguments
+CLIP_BACKENDS = ["torch", "onnx", "onnx_int8"]
+CLIP_BACKEND_HELP = ("image tower runtime: eager PyTorch, or ONNX Runtime on the CPU with fp32 (onnx) "
+                     "or int8-quantized (onnx_int8) weights")
+
+
+def run_pipeline(args):
+    from . import report
+
+    warnings.filterwarnings("ignore")
+    report.set_headless(args.headless)
+    last_stage = STAGES.index(args.stop_after)
+    start_time = time.perf_counter()
+
+    # Stage modules are imported only when they run, so e.g. a run from the merged
+    # table never loads torch or open_clip
+    if args.from_merged:
+        from . import preprocess, tables
+        merged = tables.read_table(args.merged_path, columns=preprocess.MERGED_COLUMNS)
+    else:
+        from . import extract, preprocess
+        df = preprocess.load_listings(args.listings).iloc[:preprocess.SUBSET_ROWS].reset_index(drop=True)
+        merged = extract.run(df, zip_path=args.images, batch_size=args.batch_size,
+                             num_workers=args.num_workers, backend=args.clip_backend, n_shards=args.shards,
+                             processes=args.processes, threads_per_worker=args.threads_per_worker,
+                             dedup=args.dedup, dedup_max_distance=args.dedup_max_distance)
+
+    if last_stage >= STAGES.index("preprocess"):
+        from . import preprocess
+        X, y, cities, preprocessing = preprocess.run(merged)
+
+    if last_stage >= STAGES.index("train"):
+        from . import train
+        from .experiment import ExperimentContext
+        context = ExperimentContext(X, y, cities, preprocessing)
+        trained = train.run(context, search_mode=args.search, gbr_engine=args.gbr_engine)
+
+    if last_stage >= STAGES.index("evaluate"):
+        from . import evaluate
+        results = evaluate.run(trained, context)
+
+        # Persist the fitted preprocessing and the best model for `predict`
+        if args.bundle_dir:
+            from . import bundle
+            bundle.save_bundle(bundle.build_bundle(trained, results, context, preprocessing), args.bundle_dir)
+
+    if last_stage >= STAGES.index("report"):
+        report.run(results, y)
+        if args.gbr_engine == "both":
+            report.compare_engines(trained, results)
+
+    print(f"\nPipeline finished in {time.perf_counter() - start_time:,.1f}s")
+
+
+def extract_shard(args):
+    # One shard of a sharded extraction, e.g. on another host sharing the filesystem;
+    # `run --shards N` merges the shards once all of them have finished
+    from . import extract, preprocess
+
+    warnings.filterwarnings("ignore")
+    df = preprocess.load_listings(args.listings).iloc[:preprocess.SUBSET_ROWS].reset_index(drop=True)
+    extract.extract_shard(df, args.images, args.shard, args.shards, batch_size=args.batch_size,
+                          num_workers=args.num_workers, backend=args.clip_backend, num_threads=args.threads)
+
+
+def predict(args):
+    from . import bundle
+
+    warnings.filterwarnings("ignore")
+    bundle.predict_listings(args.bundle, args.listings, images=args.images, out_path=args.out,
+                            batch_size=args.batch_size, clip_batch_size=args.clip_batch_size,
+                            num_workers=args.num_workers, backend=args.backend,
+                            clip_backend=args.clip_backend)
+
+
+def refresh(args):
+    from . import refresh, tables
+
+    warnings.filterwarnings("ignore")
+    pending_path = refresh.run(args.listings, images=args.images, history_path=args.merged_path,
+                               bundle_dir=args.bundle_dir, clip_batch_size=args.clip_batch_size,
+                               num_workers=args.num_workers, clip_backend=args.clip_backend)
+    # Past the drift thresholds, retrain from scratch on the history with the new listings;
+    # only once that bundle is saved does the pending table become the history
+    if pending_path is not None and not args.no_retrain:
+        main(["run", "--from-merged", "--merged-path", pending_path, "--headless",
+              "--bundle-dir", args.bundle_dir])
+        tables.replace_table(pending_path, args.merged_path)
+        print(f"'{args.merged_path}' now includes the new listings")
+
+
+def run_service(args):
+    import asyncio
+
+    from . import serve
+
+    warnings.filterwarnings("ignore")
+    asyncio.run(serve.serve(args.bundle, host=args.host, port=args.port,
+                            max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                            backend=args.backend, clip_backend=args.clip_backend))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m realestate")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the training pipeline end to end")
+    run_parser.add_argument("--listings", default="Property_listings.csv")
+    run_parser.add_argument("--images", default="Test_images.zip")
+    run_parser.add_argument("--from-merged", action="store_true",
+                            help="skip extraction and load the merged Parquet table of an earlier run")
+    run_parser.add_argument("--merged-path", default="merged_with_clip.parquet")
+    run_parser.add_argument("--stop-after", choices=STAGES, default="report")
+    run_parser.add_argument("--batch-size", type=int, default=64)
+    run_parser.add_argument("--num-workers", type=int, default=None)
+    run_parser.add_argument("--clip-backend", choices=CLIP_BACKENDS, default="torch", help=CLIP_BACKEND_HELP)
+    run_parser.add_argument("--shards", type=int, default=1,
+                            help="split extraction into this many shards by property_id, run in parallel "
+                                 "processes; shards already finished (e.g. by extract-shard) are reused")
+    run_parser.add_argument("--processes", type=int, default=None,
+                            help="worker processes for the shards (default: one per shard, up to the core count)")
+    run_parser.add_argument("--threads-per-worker", type=int, default=None,
+                            help="torch threads per shard worker (default: the cores split between the workers)")
+    run_parser.add_argument("--dedup", action="store_true",
+                            help="encode one listing per group of identical or near-identical photos "
+                                 "and copy its scores to the rest of the group")
+    run_parser.add_argument("--dedup-max-distance", type=int, default=4,
+                            help="largest perceptual hash distance (of 64 bits) counted as the same photo")
+    run_parser.add_argument("--search", choices=["exhaustive", "halving", "warm_start"], default="exhaustive",
+                            help="halving runs successive-halving searches over the same grids; "
+                                 "warm_start gives the exhaustive results while growing each "
+                                 "ensemble once per parameter combination")
+    run_parser.add_argument("--gbr-engine", choices=["exact", "hist", "both"], default="exact",
+                            help="gradient boosting stage: GradientBoostingRegressor (exact), "
+                                 "HistGradientBoostingRegressor with a categorical city (hist), or both "
+                                 "with a timing and MAE comparison")
+    run_parser.add_argument("--headless", action="store_true", help="skip every figure")
+    run_parser.add_argument("--bundle-dir", default="models",
+                            help="where the model bundle is saved after evaluation ('' to skip)")
+    run_parser.set_defaults(func=run_pipeline)
+
+    shard_parser = subparsers.add_parser("extract-shard", help="extract the CLIP features of one shard of the listings")
+    shard_parser.add_argument("--shard", type=int, required=True, help="index of this shard, from 0")
+    shard_parser.add_argument("--shards", type=int, required=True, help="total number of shards")
+    shard_parser.add_argument("--listings", default="Property_listings.csv")
+    shard_parser.add_argument("--images", default="Test_images.zip")
+    shard_parser.add_argument("--batch-size", type=int, default=64)
+    shard_parser.add_argument("--num-workers", type=int, default=None)
+    shard_parser.add_argument("--threads", type=int, default=None, help="torch threads for this shard")
+    shard_parser.add_argument("--clip-backend", choices=CLIP_BACKENDS, default="torch", help=CLIP_BACKEND_HELP)
+    shard_parser.set_defaults(func=extract_shard)
+
+    predict_parser = subparsers.add_parser("predict", help="price new listings with a saved model bundle")
+    predict_parser.add_argument("--bundle", default="models",
+                                help="bundle file, or a directory whose latest bundle is used")
+    predict_parser.add_argument("--listings", required=True,
+                                help="CSV or Parquet file of listings, with or without the CLIP score columns")
+    predict_parser.add_argument("--images", default=None,
+                                help="zip file or folder of listing images, needed when scores are missing")
+    predict_parser.add_argument("--out", default="predictions.csv")
+    predict_parser.add_argument("--batch-size", type=int, default=4096)
+    predict_parser.add_argument("--clip-batch-size", type=int, default=64)
+    predict_parser.add_argument("--num-workers", type=int, default=None)
+    predict_parser.add_argument("--clip-backend", choices=CLIP_BACKENDS, default="torch", help=CLIP_BACKEND_HELP)
+    predict_parser.add_argument("--backend", choices=["native", "flat"], default="native",
+                                help="flat evaluates the trees as flattened NumPy arrays (same predictions)")
+    predict_parser.set_defaults(func=predict)
+
+    refresh_parser = subparsers.add_parser("refresh", help="fold new listings into the latest model bundle")
+    refresh_parser.add_argument("--listings", required=True,
+                                help="CSV or Parquet file of listings; those already in the merged table are skipped")
+    refresh_parser.add_argument("--images", default=None,
+                                help="zip file or folder of listing images, needed when scores are missing")
+    refresh_parser.add_argument("--merged-path", default="merged_with_clip.parquet",
+                                help="merged table of the listings trained on so far; the new ones are appended")
+    refresh_parser.add_argument("--bundle-dir", default="models")
+    refresh_parser.add_argument("--clip-batch-size", type=int, default=64)
+    refresh_parser.add_argument("--num-workers", type=int, default=None)
+    refresh_parser.add_argument("--clip-backend", choices=CLIP_BACKENDS, default="torch", help=CLIP_BACKEND_HELP)
+    refresh_parser.add_argument("--no-retrain", action="store_true",
+                                help="only report drift past the thresholds instead of retraining; the new listings "
+                                     "stay out of the merged table until a model is trained on them")
+    refresh_parser.set_defaults(func=refresh)
+
+    serve_parser = subparsers.add_parser("serve", help="price single listings over HTTP with a resident model")
+    serve_parser.add_argument("--bundle", default="models",
+                              help="bundle file, or a directory whose latest bundle is used")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--max-batch-size", type=int, default=32,
+                              help="most concurrent requests encoded and priced together")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                              help="how long the first request of a batch waits for others")
+    serve_parser.add_argument("--backend", choices=["native", "flat"], default="native",
+                              help="flat evaluates the trees as flattened NumPy arrays, which is faster "
+                                   "for the small batches a service sees")
+    serve_parser.add_argument("--clip-backend", choices=CLIP_BACKENDS, default="torch", help=CLIP_BACKEND_HELP)
+    serve_parser.set_defaults(func=run_service)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Model bundles: the fitted preprocessing and chosen estimator saved together, and batch scoring."""
+
+import copy
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from . import preprocess
+
+# Bumped whenever the bundle layout changes, so old bundles are rejected instead of misread
+BUNDLE_FORMAT_VERSION = 4
+
+BUNDLE_DIR = "models"
+LATEST_POINTER = "LATEST"
+
+
+def _library_versions():
+    import sklearn
+    import xgboost
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scikit-learn": sklearn.__version__,
+        "xgboost": xgboost.__version__,
+    }
+
+
+def select_best_model(trained, results):
+    # Lowest mean cross-validated MAE over every family and variant
+    family, variant = min(
+        ((family, variant) for family in results for variant in results[family]),
+        key=lambda key: np.mean(results[key[0]][key[1]]["mae"]),
+    )
+    return family, variant
+
+
+def build_bundle(trained, results, context, preprocessing):
+    from sklearn.base import clone
+
+    from .comps import COMPS_FEATURE
+    from .extract import CLIP_MODEL_NAME, CLIP_PRETRAINED, PROMPTS
+    from .train import MODEL_FAMILIES, family_context
+
+    if COMPS_FEATURE in context.X.columns:
+        raise ValueError(f"bundles cannot compute {COMPS_FEATURE} for new listings; "
+                         "build the bundle from a context without it")
+
+    family, variant = select_best_model(trained, results)
+    model = trained[family][variant]["model"]
+    # The untuned models are only ever fitted inside the CV folds
+    if variant == "untuned":
+        data = family_context(family, context)
+        model = clone(model).fit(data.X, data.y)
+    # Families with a native categorical city get the city_code column at prediction time
+    if MODEL_FAMILIES[family].get("city") == "categorical":
+        preprocessing = copy.copy(preprocessing).set_params(city_encoding="categorical")
+
+    scores = results[family][variant]
+    return {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "family": family,
+        "variant": variant,
+        "best_params": trained[family][variant]["best_params"],
+        "model": model,
+        "preprocessing": preprocessing,
+        "clip": {"model_name": CLIP_MODEL_NAME, "pretrained": CLIP_PRETRAINED, "prompts": PROMPTS},
+        "metrics": {name: float(np.mean(values)) for name, values in scores.items() if name != "oof_pred"},
+        "n_train_rows": len(context.y),
+        # One entry per incremental refresh (see refresh.py) since the full training run
+        "refreshes": [],
+        "versions": _library_versions(),
+    }
+
+
+def save_bundle(bundle, bundle_dir=BUNDLE_DIR):
+    # Every bundle gets its own timestamped file; LATEST names the most recent one
+    os.makedirs(bundle_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    filename = f"price_model_{bundle['family']}_{bundle['variant']}_{stamp}.joblib"
+    path = os.path.join(bundle_dir, filename)
+    joblib.dump(bundle, path)
+
+    pointer_tmp = os.path.join(bundle_dir, LATEST_POINTER + ".tmp")
+    with open(pointer_tmp, "w") as f:
+        f.write(filename + "\n")
+    os.replace(pointer_tmp, os.path.join(bundle_dir, LATEST_POINTER))
+
+    print(f"Saved {bundle['family']} ({bundle['variant']}) bundle to '{path}' "
+          f"(CV MAE ${bundle['metrics']['mae']:,.2f})")
+    return path
+
+
+def load_bundle(path=BUNDLE_DIR):
+    # Accepts a bundle file, or a directory whose LATEST pointer names one
+    if os.path.isdir(path):
+        with open(os.path.join(path, LATEST_POINTER)) as f:
+            path = os.path.join(path, f.read().strip())
+
+    bundle = joblib.load(path)
+    version = bundle.get("format_version")
+    if version != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"{path} has bundle format {version}, expected {BUNDLE_FORMAT_VERSION}")
+
+    current = _library_versions()
+    mismatched = {name: (saved, current.get(name)) for name, saved in bundle["versions"].items()
+                  if name != "python" and current.get(name) != saved}
+    for name, (saved, now) in mismatched.items():
+        print(f"Warning: bundle was saved with {name} {saved}, running {now}")
+    return bundle
+
+
+class PricePredictor:
+    # Loads a bundle once and scores new listings in batches. backend="flat" evaluates the
+    # trees with the flattened NumPy ensemble from flat_trees instead of the model's predict.
+    def __init__(self, bundle, backend="native"):
+        if isinstance(bundle, (str, os.PathLike)):
+            bundle = load_bundle(bundle)
+        self.bundle = bundle
+        self.model = bundle["model"]
+        if backend == "flat":
+            from .flat_trees import flatten_model
+            self.predict_features = flatten_model(self.model).predict
+        else:
+            self.predict_features = self.model.predict
+        self.preprocessing = bundle["preprocessing"]
+        self.batch_latencies = []
+
+    def add_clip_scores(self, listings, image_source, batch_size=64, num_workers=None, cache_dir="clip_cache",
+                        clip_backend="torch"):
+        # Score listing images with the CLIP checkpoint and prompts the bundle was trained on
+        from .extract import ClipEncoder, EmbeddingCache, PromptBank, extract_clip_features
+
+        clip = self.bundle["clip"]
+        encoder = ClipEncoder(clip["model_name"], clip["pretrained"], backend=clip_backend)
+        prompt_bank = PromptBank(clip["prompts"], encoder)
+        cache = EmbeddingCache(cache_dir, encoder.model_name, encoder.pretrained, encoder.backend)
+        clip_features, _ = extract_clip_features(listings, image_source, encoder, prompt_bank, cache=cache,
+                                                 batch_size=batch_size, num_workers=num_workers)
+        return pd.merge(listings, clip_features, on="property_id", how="left")
+
+    def predict(self, listings, batch_size=4096):
+        # Listings need the structured columns and the CLIP score columns. Rows with
+        # missing or unparseable values get a NaN prediction instead of failing the batch.
+        predictions = np.full(len(listings), np.nan)
+        self.batch_latencies = []
+        start_time = time.perf_counter()
+
+        for start in range(0, len(listings), batch_size):
+            batch_start = time.perf_counter()
+            features = self.preprocessing.transform_frame(listings.iloc[start:start + batch_size])
+            # A NaN city_code is a rare or unseen city, not a missing value
+            valid = features.drop(columns=[preprocess.CITY_CODE_FEATURE], errors="ignore").notna().all(axis=1).to_numpy()
+            if valid.any():
+                predictions[start:start + batch_size][valid] = self.predict_features(features[valid])
+            self.batch_latencies.append(time.perf_counter() - batch_start)
+
+        elapsed = time.perf_counter() - start_time
+        latencies_ms = np.array(self.batch_latencies) * 1000
+        if len(latencies_ms):
+            print(f"Scored {len(listings):,} listings in {len(latencies_ms)} batches of up to {batch_size:,}: "
+                  f"{len(listings) / elapsed:,.0f} rows/sec, batch latency "
+                  f"p50 {np.percentile(latencies_ms, 50):.1f} ms, "
+                  f"p95 {np.percentile(latencies_ms, 95):.1f} ms, max {latencies_ms.max():.1f} ms")
+        skipped = int(np.isnan(predictions).sum())
+        if skipped:
+            print(f"{skipped:,} listings had missing features and were not scored")
+        return predictions
+
+
+def read_listings(path):
+    # New listings as a CSV export or a Parquet table
+    if path.endswith(".parquet"):
+        from .tables import read_table
+        return read_table(path)
+    return preprocess.load_listings(path)
+
+
+def predict_listings(bundle_path, listings_path, images=None, out_path="predictions.csv",
+                     batch_size=4096, clip_batch_size=64, num_workers=None, backend="native", clip_backend="torch"):
+    start_time = time.perf_counter()
+    predictor = PricePredictor(bundle_path, backend=backend)
+    print(f"Loaded {predictor.bundle['family']} ({predictor.bundle['variant']}) bundle "
+          f"in {time.perf_counter() - start_time:,.2f}s")
+
+    listings = read_listings(listings_path)
+    missing_scores = [col for col in preprocess.SCORE_FEATURES if col not in listings.columns]
+    if missing_scores:
+        if images is None:
+            raise ValueError(f"{listings_path} has no {', '.join(missing_scores)} columns; "
+                             "pass the listing images to score them with CLIP")
+        from .extract import DirectoryImageSource, ZipImageSource
+        image_source = DirectoryImageSource(images) if os.path.isdir(images) else ZipImageSource(images)
+        listings = predictor.add_clip_scores(listings.drop(columns=[col for col in preprocess.SCORE_FEATURES
+                                                                     if col in listings.columns]),
+                                             image_source, batch_size=clip_batch_size, num_workers=num_workers,
+                                             clip_backend=clip_backend)
+
+    predictions = pd.DataFrame({"property_id": listings["property_id"],
+                                "predicted_price": predictor.predict(listings, batch_size=batch_size)})
+    predictions.to_csv(out_path, index=False)
+    print(f"Predictions saved to '{out_path}'")
+    return predictions
@@ -0,0 +1,251 @@
+"""Comparable properties: an IVF nearest-neighbour index over CLIP embeddings and structured features."""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from .preprocess import _to_float
+
+COMPS_FEATURE = "comps_median_price"
+COMPS_K = 10
+
+# Structured features appended to the image embedding, capped and standardised as in
+# preprocessing, then weighted against the unit-norm embedding: at 0.5, one standard
+# deviation of square footage moves a listing about as far as a clearly different photo
+COMPS_STRUCTURED = ["num_bedrooms", "num_bathrooms", "square_feet"]
+STRUCTURED_WEIGHT = 0.5
+
+# Cells of the index scanned per query
+N_PROBE = 8
+
+
+def comps_vectors(embeddings, structured, weight=STRUCTURED_WEIGHT):
+    # One row per listing; rows without an embedding stay NaN and are left out of the index
+    structured = np.asarray(structured, dtype=np.float32)
+    return np.ascontiguousarray(np.hstack([np.asarray(embeddings, dtype=np.float32), weight * structured]))
+
+
+def scale_structured(preprocessing, listings):
+    # The comps columns of any frame of listings, capped and standardised with the
+    # fitted preprocessing, so new listings land where the indexed ones do
+    columns = [preprocessing.feature_columns_.index(col) for col in COMPS_STRUCTURED]
+    values = np.column_stack([_to_float(pd.Series(listings[col])).to_numpy() for col in COMPS_STRUCTURED])
+    values = np.clip(values, preprocessing.lower_[columns], preprocessing.upper_[columns])
+    return (values - preprocessing.mean_[columns]) / preprocessing.scale_[columns]
+
+
+def _squared_distances(queries, vectors, vector_norms):
+    return (np.einsum("ij,ij->i", queries, queries)[:, None] - 2 * queries @ vectors.T) + vector_norms
+
+
+def _top_k(distances, k, ids=None):
+    # The k smallest distances of each row (unsorted) and their ids, or their columns
+    if distances.shape[1] > k:
+        columns = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    ids = columns if ids is None else np.take_along_axis(ids, columns, axis=1)
+    return np.take_along_axis(distances, columns, axis=1), ids
+
+
+def _sorted_results(distances, ids):
+    # Nearest first; slots with no neighbour (too few candidates) get id -1
+    order = np.argsort(distances, axis=1, kind="stable")
+    distances = np.take_along_axis(distances, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    ids[~np.isfinite(distances)] = -1
+    return distances, ids
+
+
+class ExactIndex:
+    # Brute-force search over every vector: the ground truth for IVFIndex's recall
+    def fit(self, vectors):
+        self.vectors_ = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.norms_ = np.einsum("ij,ij->i", self.vectors_, self.vectors_)
+        return self
+
+    def search(self, queries, k=COMPS_K, exclude=None, chunk_size=1024):
+        # Squared distances and indices of each query's k nearest vectors. exclude holds
+        # one index per query (-1 for none) that is never returned, e.g. the query itself.
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        k = min(k, len(self.vectors_))
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        ids = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_distances = _squared_distances(queries[chunk], self.vectors_, self.norms_)
+            if exclude is not None:
+                rows = np.flatnonzero(exclude[chunk] >= 0)
+                chunk_distances[rows, exclude[chunk][rows]] = np.inf
+            distances[chunk], ids[chunk] = _top_k(chunk_distances, k)
+        return _sorted_results(distances, ids)
+
+
+class IVFIndex:
+    # Inverted-file index: k-means splits the vectors into n_lists cells (sqrt(n) by
+    # default) stored contiguously, and a query scans only the n_probe cells whose
+    # centroids are nearest, exactly. Bulk search groups the queries by cell, so each
+    # cell is compared against all of its queries in one matrix product.
+    def __init__(self, n_lists=None, n_probe=N_PROBE, random_state=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+    def fit(self, vectors):
+        from sklearn.cluster import MiniBatchKMeans
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, n_init=1, batch_size=4096,
+                                 random_state=self.random_state).fit(vectors)
+        self.centroids_ = kmeans.cluster_centers_.astype(np.float32)
+        self.centroid_norms_ = np.einsum("ij,ij->i", self.centroids_, self.centroids_)
+
+        cells = kmeans.labels_
+        self.ids_ = np.argsort(cells, kind="stable")
+        self.vectors_ = vectors[self.ids_]
+        self.norms_ = np.einsum("ij,ij->i", self.vectors_, self.vectors_)
+        self.offsets_ = np.r_[0, np.cumsum(np.bincount(cells, minlength=n_lists))]
+        return self
+
+    def search(self, queries, k=COMPS_K, n_probe=None, exclude=None):
+        # Same results layout as ExactIndex.search, from the n_probe nearest cells only
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids_))
+        _, probes = _top_k(_squared_distances(queries, self.centroids_, self.centroid_norms_), n_probe)
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        cells = probes.ravel()
+        query_rows = np.repeat(np.arange(len(queries)), n_probe)
+        order = np.argsort(cells, kind="stable")
+        cells, query_rows = cells[order], query_rows[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+
+        for start, end in zip(starts, np.r_[starts[1:], len(cells)]):
+            cell = cells[start]
+            low, high = self.offsets_[cell], self.offsets_[cell + 1]
+            if low == high:
+                continue
+            rows = query_rows[start:end]
+            cell_ids = self.ids_[low:high]
+            cell_distances = _squared_distances(queries[rows], self.vectors_[low:high], self.norms_[low:high])
+            if exclude is not None:
+                cell_distances[exclude[rows, None] == cell_ids[None, :]] = np.inf
+            # Merge this cell's candidates into each query's running top k
+            distances[rows], ids[rows] = _top_k(
+                np.hstack([distances[rows], cell_distances]), k,
+                np.hstack([ids[rows], np.broadcast_to(cell_ids, cell_distances.shape)]))
+        return _sorted_results(distances, ids)
+
+
+def comps_median_prices(vectors, y, reference=None, k=COMPS_K, n_probe=N_PROBE):
+    # Median price of each listing's k nearest reference listings (all of them by default),
+    # from an IVF index over the reference rows; a reference listing is never its own comp.
+    # Listings without an embedding get the median reference price.
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.isfinite(vectors).all(axis=1)
+    reference = np.arange(len(y)) if reference is None else np.asarray(reference)
+    reference = reference[valid[reference]]
+
+    values = np.full(len(y), np.median(y[reference]))
+    queries = np.flatnonzero(valid)
+    position = np.full(len(y), -1)
+    position[reference] = np.arange(len(reference))
+    index = IVFIndex(n_probe=n_probe).fit(vectors[reference])
+    _, neighbours = index.search(vectors[queries], k, exclude=position[queries])
+    prices = np.where(neighbours >= 0, y[reference][neighbours], np.nan)
+    values[queries] = np.nanmedian(prices, axis=1)
+    return values
+
+
+class FoldComps:
+    # Fold-local comps_median_price for one set of CV folds: each fold's values come from
+    # an index over that fold's training rows only, so no row's comps include a price it
+    # is scored against. fold_frame mirrors preprocess.FoldCityEncoding.
+    def __init__(self, vectors, y, folds, k=COMPS_K, n_probe=N_PROBE):
+        self.values_ = np.column_stack([comps_median_prices(vectors, y, train_idx, k, n_probe)
+                                        for train_idx, _ in folds])
+
+    def fold_frame(self, X, k, column=COMPS_FEATURE):
+        # X with the comps column computed from fold k's training rows, for every row
+        return X.assign(**{column: self.values_[:, k].astype(X[column].dtype)})
+
+
+class CompsIndex:
+    # Comparable listings for appraisers: every listing with a cached embedding, indexed
+    # once with its price and details. listings needs property_id, the structured columns
+    # and price, aligned with embeddings.
+    def __init__(self, listings, embeddings, preprocessing, weight=STRUCTURED_WEIGHT, n_probe=N_PROBE):
+        self.preprocessing = preprocessing
+        self.weight = weight
+        vectors = comps_vectors(embeddings, scale_structured(preprocessing, listings), weight)
+        valid = np.isfinite(vectors).all(axis=1)
+        self.listings = listings[valid].reset_index(drop=True)
+        self.vectors = vectors[valid]
+        self.index = IVFIndex(n_probe=n_probe).fit(self.vectors)
+        self._positions = {property_id: i for i, property_id in enumerate(self.listings["property_id"])}
+
+    def comps(self, listing, embedding=None, k=COMPS_K):
+        # The k listings nearest to `listing` (a dict or Series of the structured fields),
+        # nearest first, with their distance. A new listing needs its normalised CLIP image
+        # embedding; without one it must already be indexed, and is left out of its own comps.
+        if embedding is None:
+            if listing.get("property_id") not in self._positions:
+                raise ValueError("listing is not in the index; pass its CLIP image embedding")
+            exclude = self._positions[listing["property_id"]]
+            query = self.vectors[exclude]
+        else:
+            structured = scale_structured(self.preprocessing, pd.DataFrame([dict(listing)]))
+            query = comps_vectors(np.asarray(embedding, dtype=np.float32)[None], structured, self.weight)[0]
+            exclude = -1
+
+        distances, neighbours = self.index.search(query[None], k, exclude=np.array([exclude]))
+        found = neighbours[0] >= 0
+        comps = self.listings.iloc[neighbours[0][found]].reset_index(drop=True)
+        return comps.assign(distance=np.sqrt(np.maximum(distances[0][found], 0)))
+
+
+def benchmark(vectors, k=COMPS_K, n_probes=(1, 2, 4, 8, 16, 32), n_queries=1000, n_single=200, random_state=0):
+    # Recall@k of the IVF index against exact search for a sample of the listings as
+    # queries (each left out of its own results), with bulk throughput in queries/sec and
+    # the p50 latency of single-listing lookups
+    vectors = vectors[np.isfinite(vectors).all(axis=1)]
+    rng = np.random.default_rng(random_state)
+    query_idx = rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)
+
+    def timed(search):
+        start_time = time.perf_counter()
+        _, found = search(vectors[query_idx], query_idx)
+        queries_per_sec = len(query_idx) / (time.perf_counter() - start_time)
+        latencies = []
+        for i in query_idx[:n_single]:
+            start_time = time.perf_counter()
+            search(vectors[i:i + 1], np.array([i]))
+            latencies.append(time.perf_counter() - start_time)
+        return found, queries_per_sec, np.percentile(latencies, 50) * 1000
+
+    exact = ExactIndex().fit(vectors)
+    truth, queries_per_sec, p50 = timed(lambda queries, exclude: exact.search(queries, k, exclude=exclude))
+    rows = [{"index": "exact", "n_probe": len(vectors), "recall@k": 1.0, "queries/sec": queries_per_sec,
+             "p50 ms": p50}]
+
+    start_time = time.perf_counter()
+    ivf = IVFIndex().fit(vectors)
+    build_seconds = time.perf_counter() - start_time
+    for n_probe in n_probes:
+        if n_probe > len(ivf.centroids_):
+            break
+        found, queries_per_sec, p50 = timed(
+            lambda queries, exclude: ivf.search(queries, k, n_probe=n_probe, exclude=exclude))
+        recall = np.mean([len(np.intersect1d(row[row >= 0], expected[expected >= 0])) / k
+                          for row, expected in zip(found, truth)])
+        rows.append({"index": "ivf", "n_probe": n_probe, "recall@k": recall, "queries/sec": queries_per_sec,
+                     "p50 ms": p50})
+
+    results = pd.DataFrame(rows)
+    print(f"Comps search over {len(vectors):,} listings ({vectors.shape[1]} dimensions), top {k}; "
+          f"IVF index with {len(ivf.centroids_)} cells built in {build_seconds:,.2f}s")
+    print(results.to_string(index=False, float_format=lambda v: f"{v:,.3g}"))
+    return results
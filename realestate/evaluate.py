@@ -0,0 +1,91 @@
+"""Evaluation stage: stratified k-fold MAE and R² for every trained model."""
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import mean_absolute_error, r2_score
+from xgboost import XGBRegressor
+
+from .experiment import fit_xgboost_fold
+from .train import MODEL_FAMILIES, family_context
+
+VARIANT_TITLES = {
+    "untuned": "Untuned",
+    "random": "Random Search Tuned",
+    "grid": "Grid Search Tuned",
+}
+
+
+def mae_percentage(y_true, y_pred):
+    # MAE as a percentage of the mean price in the fold
+    return mean_absolute_error(y_true, y_pred) / np.mean(y_true) * 100
+
+
+# Every metric is computed from the same fitted fold models and predictions,
+# so registering another one costs no extra training
+METRICS = {
+    "mae": mean_absolute_error,
+    "r2": r2_score,
+    "mae_pct": mae_percentage,
+}
+
+
+def register_metric(name, metric):
+    METRICS[name] = metric
+
+
+def _fit_and_predict(model, X_train, y_train, X_test):
+    return clone(model).fit(X_train, y_train).predict(X_test)
+
+
+def cross_validate_model(model, context, metrics=None, n_jobs=-1):
+    # Fit each fold once and score its predictions with every registered metric.
+    # The out-of-fold predictions are kept under "oof_pred" for the diagnostic plots,
+    # so they come from exactly the folds behind the reported metrics. The folds and
+    # their data come from the shared ExperimentContext.
+    metrics = metrics or METRICS
+    if type(model) is XGBRegressor:
+        # Trained on the folds' cached matrices (early-stopping subclasses split their
+        # own validation rows, so they fit as usual)
+        fold_predictions = []
+        for k in range(context.n_splits):
+            booster, dtest = fit_xgboost_fold(model, context, k)
+            fold_predictions.append(booster.predict(dtest))
+    else:
+        fold_predictions = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_and_predict)(model, *context.fold_data(k)[:3]) for k in range(context.n_splits)
+        )
+
+    scores = {name: np.empty(context.n_splits) for name in metrics}
+    oof_pred = np.empty(len(context.y))
+    for i, ((_, test_idx), y_pred) in enumerate(zip(context.folds, fold_predictions)):
+        y_true = context.fold_data(i)[3]
+        for name, metric in metrics.items():
+            scores[name][i] = metric(y_true, y_pred)
+        oof_pred[test_idx] = y_pred
+    scores["oof_pred"] = oof_pred
+    return scores
+
+
+def print_cv_results(title, scores, best_params=None):
+    print(f"\n 5-Fold CV: {title} with StratifiedKFold")
+    if best_params is not None:
+        print("\n Best Hyperparameters:", best_params)
+    print("\n MAE Scores:", scores["mae"])
+    print(" R² Scores: ", scores["r2"])
+    print(f"\n Avg MAE: ${np.mean(scores['mae']):,.2f}")
+    print(f" Avg R²: {np.mean(scores['r2']):.4f}")
+    if "mae_pct" in scores:
+        print(f" Avg MAE % of mean price: {np.mean(scores['mae_pct']):.2f}%")
+
+
+def run(trained, context):
+    results = {}
+    for family, variants in trained.items():
+        results[family] = {}
+        for variant, entry in variants.items():
+            scores = cross_validate_model(entry["model"], family_context(family, context))
+            print_cv_results(f"{VARIANT_TITLES[variant]} {MODEL_FAMILIES[family]['name']}",
+                             scores, entry["best_params"])
+            results[family][variant] = scores
+    return results
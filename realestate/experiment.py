@@ -0,0 +1,116 @@
+"""Experiment context: the folds and fold data shared by every model family's searches and evaluation."""
+
+import functools
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+
+from .preprocess import CITY_CODE_FEATURE, CITY_FEATURE, FoldCityEncoding
+
+# Every family and variant is searched and evaluated on the same folds
+CV_SEED = 42
+N_SPLITS = 5
+
+
+def stratified_cv(X, y, random_state=CV_SEED, n_splits=N_SPLITS):
+    # Binning target variable for stratification
+    y_binned = pd.qcut(y, q=5, labels=False, duplicates='drop')
+    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    return skf.split(X, y_binned)
+
+
+class ExperimentContext:
+    # Built once after preprocessing and handed to every search and evaluation: the
+    # stratified folds are materialised a single time, X is held as one contiguous
+    # float32 array, and each fold's training and test arrays (and XGBoost matrices) are
+    # sliced once and reused by every candidate. Given each row's city, city_avg_price
+    # is encoded inside every fold from that fold's training rows only, and with the
+    # fitted preprocessing, categorical() gives the same folds over the city_code features.
+    # comps (a comps.FoldComps on the same folds) does the same for a comps_median_price column.
+    def __init__(self, X, y, cities=None, preprocessing=None, cv_seed=CV_SEED, n_splits=N_SPLITS, folds=None,
+                 comps=None):
+        # The DataFrame is kept for the final refits, so those models keep feature names
+        self.X = X
+        self.y = np.asarray(y, dtype=np.float64)
+        self.cities = cities
+        self.preprocessing = preprocessing
+        self.cv_seed = cv_seed
+        self.folds = folds if folds is not None else list(stratified_cv(X, y, cv_seed, n_splits))
+        has_target_encoding = cities is not None and CITY_FEATURE in X.columns
+        self.encoding = FoldCityEncoding(cities, self.y, self.folds) if has_target_encoding else None
+        self.comps = comps
+        # Every column re-computed inside each fold
+        self.fold_features = [feature for feature in (self.encoding, comps) if feature is not None]
+        self.X_array = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+        self._fold_data = {}
+        self._dmatrices = {}
+
+    @property
+    def n_splits(self):
+        return len(self.folds)
+
+    @property
+    def city_column(self):
+        # Position of the city feature, whichever encoding it has
+        return self.X.columns.get_indexer([CITY_FEATURE, CITY_CODE_FEATURE]).max()
+
+    @functools.cached_property
+    def categorical(self):
+        # The same rows and folds with city as a category code instead of a target
+        # encoding; categories never see the prices, so no fold-local encoding is needed
+        if self.preprocessing is None or self.cities is None:
+            raise ValueError("categorical city features need the cities and the fitted preprocessing")
+        X = self.X.assign(**{CITY_FEATURE: self.preprocessing.city_codes(self.cities).astype(np.float32)})
+        X = X.rename(columns={CITY_FEATURE: CITY_CODE_FEATURE})
+        return ExperimentContext(X, self.y, folds=self.folds, cv_seed=self.cv_seed, comps=self.comps)
+
+    def fold_X(self, k):
+        # Every row of X as fold k's models see it
+        if not self.fold_features:
+            return self.X_array
+        X = self.X
+        for feature in self.fold_features:
+            X = feature.fold_frame(X, k)
+        return np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+
+    def fold_data(self, k):
+        # (X_train, y_train, X_test, y_test) of fold k
+        if k not in self._fold_data:
+            train_idx, test_idx = self.folds[k]
+            X_fold = self.fold_X(k)
+            self._fold_data[k] = (X_fold[train_idx], self.y[train_idx], X_fold[test_idx], self.y[test_idx])
+        return self._fold_data[k]
+
+    def dmatrices(self, k, max_bin=None):
+        # Fold k's training QuantileDMatrix and test DMatrix. The quantile sketch depends
+        # only on the data, so every XGBoost candidate with the same max_bin shares it.
+        if (k, max_bin) not in self._dmatrices:
+            import xgboost
+
+            X_train, y_train, X_test, _ = self.fold_data(k)
+            self._dmatrices[(k, max_bin)] = (xgboost.QuantileDMatrix(X_train, label=y_train, max_bin=max_bin),
+                                             xgboost.DMatrix(X_test))
+        return self._dmatrices[(k, max_bin)]
+
+    @functools.cached_property
+    def search_data(self):
+        # X, y and cv for scikit-learn searches, which take a single X: with fold-local
+        # features, one copy of X per fold with each fold's indices pointing into its own copy
+        if not self.fold_features:
+            return self.X_array, self.y, self.folds
+        n_rows = len(self.y)
+        X_stacked = np.concatenate([self.fold_X(k) for k in range(self.n_splits)])
+        y_stacked = np.tile(self.y, self.n_splits)
+        cv = [(train_idx + k * n_rows, test_idx + k * n_rows) for k, (train_idx, test_idx) in enumerate(self.folds)]
+        return X_stacked, y_stacked, cv
+
+
+def fit_xgboost_fold(model, context, k):
+    # What XGBRegressor.fit does, on fold k's cached QuantileDMatrix; returns the booster
+    # and the fold's test DMatrix. Gives exactly the predictions of model.fit on the fold.
+    import xgboost
+
+    dtrain, dtest = context.dmatrices(k, model.max_bin)
+    booster = xgboost.train(model.get_xgb_params(), dtrain, model.get_num_boosting_rounds())
+    return booster, dtest
@@ -0,0 +1,886 @@
+"""Feature extraction stage: scores listing images against CLIP prompts."""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from . import report, tables
+
+CLIP_MODEL_NAME = 'ViT-B-32'
+CLIP_PRETRAINED = 'laion2b_s34b_b79k'
+
+# Prompt definitions (final version)
+PROMPTS = {
+    "garage_present": [
+        "a house with a garage",
+        "a house without a garage"
+    ],
+    "greenery": [
+        "a house surrounded by lush greenery, trees, and plants",
+        "a house in an urban environment with no vegetation"
+    ],
+    "window_count": [
+        "a house with large multiple front-facing windows",
+        "a house with small or very few windows visible from outside"
+    ],
+    "driveway_yard": [
+        "a house with a concrete driveway or grassy front yard",
+        "a house with no driveway or front yard space in front"
+    ],
+}
+
+
+# Image tower backends. "onnx" runs the tower exported to ONNX under ONNX Runtime on the
+# CPU, and "onnx_int8" the same graph with its weights dynamically quantized to int8.
+# The text tower always runs in PyTorch: prompts are only encoded once per run.
+CLIP_BACKENDS = ["torch", "onnx", "onnx_int8"]
+ONNX_DIR = "clip_onnx"
+
+# Largest absolute difference in any *_score column that benchmark_backends accepts
+SCORE_PARITY_TOLERANCE = 0.02
+
+# Largest Hamming distance between two 64-bit perceptual hashes that still counts as the
+# same photo: recompressed or resized copies land within a few bits of each other
+DEDUP_MAX_DISTANCE = 4
+
+
+def export_image_tower(model, model_dir, quantize=False):
+    # Exports model.visual once per checkpoint (and quantizes that export once), reusing
+    # the files on later runs. Returns the path of the graph to load.
+    os.makedirs(model_dir, exist_ok=True)
+    fp32_path = os.path.join(model_dir, "image_tower.onnx")
+    if not os.path.exists(fp32_path):
+        dummy = torch.randn(1, 3, *model.visual.image_size)
+        # Traced with autograd on: under no_grad, eval-mode attention takes a fused fast
+        # path that has no ONNX export
+        torch.onnx.export(model.visual, dummy, fp32_path + ".tmp", input_names=["image"],
+                          output_names=["embedding"], opset_version=17, dynamo=False,
+                          dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}})
+        os.replace(fp32_path + ".tmp", fp32_path)
+    if not quantize:
+        return fp32_path
+
+    int8_path = os.path.join(model_dir, "image_tower_int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # Only the MatMuls, which hold nearly all the weights, with a scale per output
+        # channel; quantizing the patch-embedding Conv is slower on ONNX Runtime's CPU kernels
+        quantize_dynamic(fp32_path, int8_path + ".tmp", weight_type=QuantType.QInt8,
+                         op_types_to_quantize=["MatMul"], per_channel=True)
+        os.replace(int8_path + ".tmp", int8_path)
+    return int8_path
+
+
+class ClipEncoder:
+    # Loads the CLIP model, its image preprocessing and tokenizer once. With an ONNX
+    # backend the image tower runs in an ONNX Runtime CPU session instead of PyTorch,
+    # using num_threads threads (all cores when None).
+    def __init__(self, model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED, device=None, backend="torch",
+                 onnx_dir=ONNX_DIR, num_threads=None):
+        import open_clip
+
+        if backend not in CLIP_BACKENDS:
+            raise ValueError(f"unknown CLIP backend {backend!r}, expected one of {CLIP_BACKENDS}")
+        self.model_name = model_name
+        self.pretrained = pretrained
+        self.backend = backend
+        self.model, _, self.preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained)
+        self.tokenizer = open_clip.get_tokenizer(model_name)
+        self.session = None
+        if backend != "torch":
+            import onnxruntime
+
+            self.model.eval()
+            onnx_path = export_image_tower(self.model, os.path.join(onnx_dir, f"{model_name}__{pretrained}"),
+                                           quantize=backend == "onnx_int8")
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+            device = "cpu"
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model.to(self.device).eval()
+
+    def encode_images(self, image_input):
+        # Encode a stacked batch once and normalise the embeddings
+        with torch.no_grad():
+            if self.session is not None:
+                image_features = torch.from_numpy(
+                    self.session.run(None, {"image": image_input.cpu().numpy()})[0])
+            else:
+                image_features = self.model.encode_image(image_input.to(self.device))
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+        return image_features
+
+    def encode_text(self, texts):
+        with torch.no_grad():
+            text_features = self.model.encode_text(self.tokenizer(texts).to(self.device))
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+        return text_features
+
+
+class ZipImageSource:
+    # Serves image bytes straight out of the archive. The member index is built once from
+    # the zip's central directory, so a lookup by image_filename is a dict access followed
+    # by a seek. Each process opens its own handle because forked DataLoader workers must
+    # not share a file offset.
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            self.members = {os.path.basename(info.filename): info
+                            for info in zip_ref.infolist() if not info.is_dir()}
+        self._zip_ref = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_zip_ref"] = None
+        return state
+
+    def read(self, filename):
+        if self._zip_ref is None or self._pid != os.getpid():
+            self._zip_ref = zipfile.ZipFile(self.zip_path, "r")
+            self._pid = os.getpid()
+        return self._zip_ref.read(self.members[filename])
+
+
+class DirectoryImageSource:
+    # Same interface for images that are already extracted into a folder
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+
+    def read(self, filename):
+        with open(os.path.join(self.image_dir, filename), "rb") as f:
+            return f.read()
+
+
+class PromptBank:
+    # Encodes every prompt once into a single normalised text embedding matrix,
+    # remembering which rows belong to which feature
+    def __init__(self, prompts, encoder):
+        self.prompts = prompts
+        self.feature_slices = {}
+
+        all_prompts = []
+        for feature, prompt_list in prompts.items():
+            self.feature_slices[feature] = slice(len(all_prompts), len(all_prompts) + len(prompt_list))
+            all_prompts.extend(prompt_list)
+
+        self.text_features = encoder.encode_text(all_prompts)
+
+    def score(self, image_features):
+        # One matrix multiply against every prompt, then a softmax within each feature's group
+        image_features = image_features.to(self.text_features.device, self.text_features.dtype)
+        logits = 100.0 * image_features @ self.text_features.T
+        batch_rows = [{} for _ in range(logits.shape[0])]
+
+        for feature, cols in self.feature_slices.items():
+            prompt_list = self.prompts[feature]
+            similarity = logits[:, cols].softmax(dim=-1).tolist()
+
+            # Handle multi-class vs binary features
+            for feature_row, probs in zip(batch_rows, similarity):
+                if len(prompt_list) == 2:
+                    feature_row[f"{feature}_score"] = probs[0]
+                else:
+                    best_idx = probs.index(max(probs))
+                    feature_row[f"{feature}_pred"] = prompt_list[best_idx]
+                    feature_row[f"{feature}_confidence"] = max(probs)
+
+        return batch_rows
+
+
+def embedding_cache_name(model_name, pretrained, backend="torch"):
+    suffix = "" if backend == "torch" else f"__{backend}"
+    return f"{model_name}__{pretrained}{suffix}"
+
+
+class EmbeddingCache:
+    # On-disk store of image embeddings keyed by image content hash. Each model/pretrained
+    # pair gets its own directory holding a float16 .npy matrix (memory-mapped on load)
+    # and a JSON index mapping content hash -> matrix row. Non-torch backends get a
+    # directory of their own, so their embeddings are never mixed with PyTorch's. A base
+    # cache, such as the main cache under a shard's own, is read from but never written.
+    def __init__(self, cache_dir, model_name, pretrained, backend="torch", base=None):
+        self.cache_dir = os.path.join(cache_dir, embedding_cache_name(model_name, pretrained, backend))
+        self.matrix_path = os.path.join(self.cache_dir, "embeddings.npy")
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.index = {}
+        self.matrix = None
+        if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            self.matrix = np.load(self.matrix_path, mmap_mode="r")
+
+        # Embeddings added since the last flush
+        self.pending = {}
+        self.base = base
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.index or key in self.pending or (self.base is not None and key in self.base)
+
+    def known_hashes(self):
+        known = frozenset(self.index).union(self.pending)
+        return known | self.base.known_hashes() if self.base is not None else known
+
+    def _row(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        if key in self.index:
+            return self.matrix[self.index[key]]
+        return self.base.get_many([key])[0]
+
+    def get_many(self, keys):
+        return np.stack([self._row(key) for key in keys]).astype(np.float32)
+
+    def add(self, keys, embeddings):
+        for key, embedding in zip(keys, np.asarray(embeddings, dtype=np.float16)):
+            if key not in self:
+                self.pending[key] = embedding
+
+    def flush(self):
+        # Rewrite the matrix with the pending rows appended, then swap files in atomically
+        if not self.pending:
+            return
+
+        existing = [np.asarray(self.matrix)] if self.matrix is not None else []
+        offset = len(self.matrix) if self.matrix is not None else 0
+        matrix = np.concatenate(existing + [np.stack(list(self.pending.values()))])
+        for row, key in enumerate(self.pending, start=offset):
+            self.index[key] = row
+
+        tmp_matrix_path = self.matrix_path + ".tmp.npy"
+        np.save(tmp_matrix_path, matrix)
+        os.replace(tmp_matrix_path, self.matrix_path)
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+        self.matrix = np.load(self.matrix_path, mmap_mode="r")
+        self.pending = {}
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def perceptual_hash(data):
+    # 64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter
+    # than its left neighbour. JPEGs are decoded straight at a reduced size (draft), so
+    # this costs a fraction of CLIP's full-size preprocessing.
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (64, 64))
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), "big")
+
+
+def near_duplicate_groups(phashes, max_distance=DEDUP_MAX_DISTANCE):
+    # Group label of each hash, linking every pair at most max_distance bits apart. Two
+    # such hashes agree exactly on at least one of max_distance + 1 bit bands, so only
+    # hashes sharing a band value are ever compared.
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    unique, inverse = np.unique(np.asarray(phashes, dtype=np.uint64), return_inverse=True)
+    if max_distance == 0:
+        return inverse
+
+    rows, cols = [], []
+    bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        keys = (unique >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+        order = np.argsort(keys, kind="stable")
+        starts = np.flatnonzero(np.r_[True, keys[order][1:] != keys[order][:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            if end - start < 2:
+                continue
+            members = order[start:end]
+            distances = np.bitwise_count(unique[members, None] ^ unique[None, members])
+            i, j = np.nonzero(np.triu(distances <= max_distance, k=1))
+            rows.append(members[i])
+            cols.append(members[j])
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=int)
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(unique), len(unique)))
+    _, labels = connected_components(graph, directed=False)
+    return labels[inverse]
+
+
+class ListingImageDataset(Dataset):
+    # Reads, hashes and preprocesses the image of each listing. Runs inside the DataLoader
+    # workers, so failures are returned as data rather than raised or printed.
+    def __init__(self, df, source, preprocess, known_hashes=frozenset(), decode=True, done=None):
+        self.property_ids = df['property_id'].tolist()
+        self.filenames = df['image_filename'].tolist()
+        self.source = source
+        self.preprocess = preprocess
+        self.known_hashes = known_hashes
+        self.decode = decode
+        # property_id -> image hash of listings already scored from that very image
+        self.done = done or {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        item = {"property_id": self.property_ids[idx], "image_filename": self.filenames[idx],
+                "hash": None, "image": None, "error": None}
+        try:
+            data = self.source.read(self.filenames[idx])
+            item["hash"] = content_hash(data)
+            # Images whose embedding is already cached, or whose listing is already
+            # scored, only need hashing
+            if (self.decode and item["hash"] not in self.known_hashes
+                    and self.done.get(str(self.property_ids[idx])) != item["hash"]):
+                image = Image.open(io.BytesIO(data)).convert("RGB")
+                item["image"] = self.preprocess(image)
+        except Exception as e:
+            item["error"] = f"{type(e).__name__}: {e}"
+        return item
+
+
+class ImageHashDataset(Dataset):
+    # Content and perceptual hash of each listing's image, for the deduplication pre-pass
+    def __init__(self, df, source):
+        self.property_ids = df['property_id'].tolist()
+        self.filenames = df['image_filename'].tolist()
+        self.source = source
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        item = {"property_id": self.property_ids[idx], "hash": None, "phash": None}
+        try:
+            data = self.source.read(self.filenames[idx])
+            item["hash"] = content_hash(data)
+            item["phash"] = perceptual_hash(data)
+        except Exception:
+            # Left to the extraction itself, which records the error
+            pass
+        return item
+
+
+def collate_listing_batch(items):
+    batch = {"property_ids": [], "hashes": [], "new_hashes": [], "images": None, "errors": []}
+    images = []
+    for item in items:
+        if item["error"] is not None:
+            batch["errors"].append({key: item[key] for key in ("property_id", "image_filename", "error")})
+            continue
+        batch["property_ids"].append(item["property_id"])
+        batch["hashes"].append(item["hash"])
+        if item["image"] is not None:
+            images.append(item["image"])
+            batch["new_hashes"].append(item["hash"])
+    if images:
+        batch["images"] = torch.stack(images)
+    return batch
+
+
+def default_num_workers():
+    return max(1, min(8, (os.cpu_count() or 2) - 1))
+
+
+def make_image_loader(df, source, preprocess=None, known_hashes=frozenset(), decode=True, done=None,
+                      batch_size=64, num_workers=None, prefetch_factor=2):
+    # Worker processes decode and preprocess ahead of the model; each keeps at most
+    # `prefetch_factor` batches queued so memory stays bounded
+    num_workers = default_num_workers() if num_workers is None else num_workers
+    dataset = ListingImageDataset(df, source, preprocess, known_hashes, decode, done)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                      num_workers=num_workers, collate_fn=collate_listing_batch,
+                      prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+
+def scoring_fingerprint(model_name, pretrained, backend, prompts):
+    # Everything the scores depend on besides the image itself, as stored in JSON
+    return json.loads(json.dumps({"model_name": model_name, "pretrained": pretrained,
+                                  "backend": backend, "prompts": prompts}))
+
+
+class FeatureCheckpoint:
+    # Append-only store of extracted feature chunks. Each chunk is written to its own Parquet
+    # file and then recorded, with the property_ids it covers and the content hash of each
+    # one's image, in manifest.json. A chunk only counts as committed once the manifest is
+    # replaced, so a crash loses at most the chunk in flight and a rerun resumes after the
+    # last committed one. The manifest also holds the scoring fingerprint (model, backend
+    # and prompts): a checkpoint scored with anything else is discarded rather than reused.
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.fingerprint = None
+        self.chunks = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.fingerprint = manifest.get("fingerprint")
+            self.chunks = manifest["chunks"]
+
+    def resume(self, fingerprint):
+        # property_id -> image content hash of every committed row scored the same way
+        if self.chunks and self.fingerprint != fingerprint:
+            print("Checkpoint was scored with a different model, backend or prompts; starting over")
+            for chunk in self.chunks:
+                chunk_path = os.path.join(self.checkpoint_dir, chunk["file"])
+                if os.path.exists(chunk_path):
+                    os.remove(chunk_path)
+            self.chunks = []
+            self._write_manifest()
+        self.fingerprint = fingerprint
+        done = {}
+        for chunk in self.chunks:
+            # Chunks from before hashes were recorded never match, so they are re-scored
+            done.update(zip(chunk["property_ids"], chunk.get("hashes", [None] * len(chunk["property_ids"]))))
+        return done
+
+    def _write_manifest(self):
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "chunks": self.chunks}, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def commit(self, rows, hashes):
+        if not rows:
+            return
+        chunk_file = f"part-{len(self.chunks):05d}.parquet"
+        chunk_path = os.path.join(self.checkpoint_dir, chunk_file)
+        pd.DataFrame(rows).to_parquet(chunk_path + ".tmp", index=False)
+        os.replace(chunk_path + ".tmp", chunk_path)
+
+        self.chunks.append({"file": chunk_file,
+                            "property_ids": [str(row["property_id"]) for row in rows],
+                            "hashes": list(hashes)})
+        self._write_manifest()
+
+    def load(self):
+        if not self.chunks:
+            return pd.DataFrame(columns=["property_id"])
+        parts = [pd.read_parquet(os.path.join(self.checkpoint_dir, chunk["file"])) for chunk in self.chunks]
+        # A listing re-scored after its image changed keeps only its latest row
+        features = pd.concat(parts, ignore_index=True)
+        latest = ~features["property_id"].astype(str).duplicated(keep="last")
+        return features[latest].reset_index(drop=True)
+
+
+def extract_clip_features(df, source, encoder, prompt_bank, cache=None, checkpoint=None,
+                          batch_size=64, num_workers=None, flush_every=2048):
+    results = []
+    errors = []
+    n_images = 0
+    n_encoded = 0
+    start_time = time.perf_counter()
+
+    # Properties committed by an earlier run with the same model, backend and prompts are
+    # skipped as long as their image is unchanged; their images are only read and hashed
+    done = {}
+    if checkpoint is not None:
+        done = checkpoint.resume(scoring_fingerprint(encoder.model_name, encoder.pretrained, encoder.backend,
+                                                     prompt_bank.prompts))
+        if done:
+            print(f"Resuming: {len(done):,} properties already extracted, re-scoring only changed images")
+    result_hashes = []
+    n_reused = 0
+
+    known_hashes = cache.known_hashes() if cache is not None else frozenset()
+    loader = make_image_loader(df, source, encoder.preprocess, known_hashes=known_hashes, done=done,
+                               batch_size=batch_size, num_workers=num_workers)
+
+    for batch in tqdm(loader, total=len(loader)):
+        errors.extend(batch["errors"])
+        scored = [i for i, (property_id, digest) in enumerate(zip(batch["property_ids"], batch["hashes"]))
+                  if done.get(str(property_id)) != digest]
+        n_reused += len(batch["property_ids"]) - len(scored)
+        batch["property_ids"] = [batch["property_ids"][i] for i in scored]
+        batch["hashes"] = [batch["hashes"][i] for i in scored]
+        if not batch["property_ids"]:
+            continue
+
+        # Run one forward pass over the images that were not already cached. known_hashes
+        # is fixed when the workers start, so a photo cached by an earlier batch of this run,
+        # or repeated within the batch, is decoded again but only encoded once.
+        new_embeddings = {}
+        if batch["images"] is not None:
+            first = {}
+            for i, digest in enumerate(batch["new_hashes"]):
+                if digest not in first and (cache is None or digest not in cache):
+                    first[digest] = i
+            if first:
+                encoded = encoder.encode_images(batch["images"][list(first.values())]).cpu().numpy()
+                if cache is not None:
+                    # Score from the stored float16 values so reruns reproduce the same scores
+                    cache.add(list(first), encoded)
+                    encoded = encoded.astype(np.float16)
+                new_embeddings = dict(zip(first, encoded.astype(np.float32)))
+                n_encoded += len(first)
+
+        image_features = np.stack([
+            new_embeddings[digest] if digest in new_embeddings else cache.get_many([digest])[0]
+            for digest in batch["hashes"]
+        ])
+        feature_rows = prompt_bank.score(torch.from_numpy(image_features))
+        for property_id, feature_row in zip(batch["property_ids"], feature_rows):
+            results.append({"property_id": property_id, **feature_row})
+        result_hashes.extend(batch["hashes"])
+        n_images += len(batch["property_ids"])
+
+        # Commit a chunk once enough rows have built up, persisting new embeddings first
+        if checkpoint is not None and len(results) >= flush_every:
+            if cache is not None:
+                cache.flush()
+            checkpoint.commit(results, result_hashes)
+            results, result_hashes = [], []
+
+    if cache is not None:
+        cache.flush()
+    if checkpoint is not None:
+        checkpoint.commit(results, result_hashes)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Scored {n_images:,} images ({n_encoded:,} newly encoded) in {elapsed:,.1f}s "
+          f"({n_images / max(elapsed, 1e-9):,.1f} images/sec, batch_size={batch_size})")
+    if n_reused:
+        print(f"Reused the checkpointed scores of {n_reused:,} unchanged images")
+    if errors:
+        print(f"{len(errors):,} images failed to load, see the error manifest")
+
+    error_columns = ["property_id", "image_filename", "error"]
+    features = checkpoint.load() if checkpoint is not None else pd.DataFrame(results)
+    return features, pd.DataFrame(errors, columns=error_columns)
+
+
+def deduplicate_images(df, source, max_distance=DEDUP_MAX_DISTANCE, batch_size=256, num_workers=None):
+    # Hashes every listing image and groups identical and near-identical photos. Returns
+    # the listings to encode (the first of each group) and a property_id ->
+    # representative_id frame covering every listing. Images that can't be read or
+    # decoded stay in groups of their own, so extraction still reports them.
+    start_time = time.perf_counter()
+    num_workers = default_num_workers() if num_workers is None else num_workers
+    loader = DataLoader(ImageHashDataset(df, source), batch_size=batch_size, shuffle=False,
+                        num_workers=num_workers, collate_fn=list)
+    items = [item for batch in loader for item in batch]
+
+    hashed = [item for item in items if item["phash"] is not None]
+    labels = np.full(len(items), -1)
+    if hashed:
+        labels[[item["phash"] is not None for item in items]] = near_duplicate_groups(
+            [item["phash"] for item in hashed], max_distance)
+    # Unreadable images get labels past every real group
+    unreadable = labels < 0
+    labels[unreadable] = labels.max() + 1 + np.arange(unreadable.sum())
+
+    property_ids = pd.Series([item["property_id"] for item in items])
+    representatives = property_ids.groupby(labels).transform("first")
+    groups = pd.DataFrame({"property_id": property_ids, "representative_id": representatives})
+
+    n_duplicates = len(items) - len(np.unique(labels))
+    n_exact = len(hashed) - len({item["hash"] for item in hashed})
+    print(f"Dedup pre-pass over {len(items):,} images in {time.perf_counter() - start_time:,.1f}s: "
+          f"{n_duplicates:,} duplicates ({n_exact:,} exact, {n_duplicates - n_exact:,} near, "
+          f"max distance {max_distance}), dedup ratio {n_duplicates / max(len(items), 1):.1%}")
+    return df[df['property_id'].isin(set(representatives))], groups
+
+
+def fan_out_scores(features, groups):
+    # Scores of each representative copied to every listing in its group
+    features = features.rename(columns={"property_id": "representative_id"})
+    features["representative_id"] = features["representative_id"].astype(groups["representative_id"].dtype)
+    return groups.merge(features, on="representative_id").drop(columns="representative_id")
+
+
+def listing_embeddings(df, source, cache_dir="clip_cache", model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED,
+                       backend="torch", num_workers=None):
+    # Cached image embedding of every listing, found by hashing its image, as a float32
+    # matrix aligned with df. Shard caches are searched too; rows whose image was never
+    # encoded (unreadable, or a near-duplicate that was skipped) are NaN.
+    cache_name = embedding_cache_name(model_name, pretrained, backend)
+    cache_dirs = [cache_dir] + sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                                      if name.startswith("shard-")
+                                      and os.path.isdir(os.path.join(cache_dir, name, cache_name)))
+    caches = [EmbeddingCache(directory, model_name, pretrained, backend) for directory in cache_dirs]
+
+    found = {}
+    for batch in make_image_loader(df, source, decode=False, batch_size=256, num_workers=num_workers):
+        for property_id, digest in zip(batch["property_ids"], batch["hashes"]):
+            cache = next((cache for cache in caches if digest in cache), None)
+            if cache is not None:
+                found[property_id] = cache.get_many([digest])[0]
+    if not found:
+        raise ValueError(f"no embeddings for these listings in {cache_dir}")
+
+    embeddings = np.full((len(df), len(next(iter(found.values())))), np.nan, dtype=np.float32)
+    for i, property_id in enumerate(df['property_id']):
+        if property_id in found:
+            embeddings[i] = found[property_id]
+    print(f"{np.isfinite(embeddings[:, 0]).sum():,} of {len(df):,} listings have a cached embedding")
+    return embeddings
+
+
+def rescore_from_cache(df, source, prompt_bank, cache, batch_size=4096, num_workers=None):
+    # Re-score every cached image against a (possibly changed) prompt bank without running
+    # the image encoder; images missing from the cache are skipped
+    property_ids, hashes = [], []
+    for batch in make_image_loader(df, source, decode=False, batch_size=256, num_workers=num_workers):
+        for property_id, digest in zip(batch["property_ids"], batch["hashes"]):
+            if digest in cache:
+                property_ids.append(property_id)
+                hashes.append(digest)
+
+    print(f"{len(hashes):,} of {len(df):,} images found in the embedding cache")
+
+    results = []
+    for start in range(0, len(hashes), batch_size):
+        image_features = torch.from_numpy(cache.get_many(hashes[start:start + batch_size]))
+        feature_rows = prompt_bank.score(image_features)
+        for property_id, feature_row in zip(property_ids[start:start + batch_size], feature_rows):
+            results.append({"property_id": property_id, **feature_row})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_backends(df, source, backends=CLIP_BACKENDS, n_images=256, batch_size=64,
+                       tolerance=SCORE_PARITY_TOLERANCE):
+    # Images/sec of each image tower backend on the same preprocessed batches of the first
+    # n_images listings, and the largest absolute difference of each *_score column from
+    # the PyTorch scores of the same images
+    backends = ["torch"] + [backend for backend in backends if backend != "torch"]
+    rows, scores, batches = [], {}, None
+    for backend in backends:
+        encoder = ClipEncoder(backend=backend)
+        if batches is None:
+            # Every backend shares the checkpoint's preprocessing, so images are decoded once
+            loader = make_image_loader(df.head(n_images), source, encoder.preprocess, batch_size=batch_size)
+            batches = [batch["images"] for batch in loader if batch["images"] is not None]
+            n_loaded = sum(len(images) for images in batches)
+        prompt_bank = PromptBank(PROMPTS, encoder)
+        encoder.encode_images(batches[0])  # warm-up
+        start_time = time.perf_counter()
+        image_features = torch.cat([encoder.encode_images(images) for images in batches])
+        images_per_sec = n_loaded / (time.perf_counter() - start_time)
+
+        scores[backend] = pd.DataFrame(prompt_bank.score(image_features))
+        diffs = (scores[backend] - scores["torch"]).abs().max()
+        rows.append({"backend": backend, "images/sec": images_per_sec,
+                     "speedup": images_per_sec / rows[0]["images/sec"] if rows else 1.0,
+                     **{f"{col} max diff": diff for col, diff in diffs.items()},
+                     "within tolerance": bool((diffs <= tolerance).all())})
+
+    results = pd.DataFrame(rows)
+    print(f"CLIP image tower backends on {n_loaded:,} images, score tolerance {tolerance}:")
+    print(results.to_string(index=False, float_format=lambda v: f"{v:,.3g}"))
+    return results
+
+
+def shard_of(property_ids, n_shards):
+    # Shard of each listing from a CRC32 of its property_id, so the split is the same in
+    # every process, on every host and across reruns
+    return np.array([zlib.crc32(str(property_id).encode()) % n_shards for property_id in property_ids])
+
+
+def shard_dir(directory, shard, n_shards):
+    return os.path.join(directory, f"shard-{shard:03d}-of-{n_shards:03d}")
+
+
+def shard_signature(df, source, fingerprint):
+    # What a finished shard was scored from: its listings, a digest of the CRC and size of
+    # each one's image in the zip (read from the central directory, so nothing is
+    # decompressed) and the scoring fingerprint
+    digest = hashlib.sha1()
+    for property_id, filename in sorted(zip(df['property_id'].astype(str), df['image_filename'])):
+        info = source.members.get(filename)
+        digest.update(f"{property_id}:{filename}:{info.CRC if info else ''}:{info.file_size if info else ''}\n".encode())
+    return {"listings": len(df), "images": digest.hexdigest(), "fingerprint": fingerprint}
+
+
+def shard_done(checkpoint_dir, shard, n_shards, signature=None):
+    # Whether the shard has finished, and if a signature is given, from those very listings,
+    # images, model, backend and prompts
+    marker = os.path.join(shard_dir(checkpoint_dir, shard, n_shards), "done.json")
+    if not os.path.exists(marker):
+        return False
+    with open(marker) as f:
+        done = json.load(f)
+    return signature is None or all(done.get(key) == value for key, value in signature.items())
+
+
+def extract_shard(df, zip_path, shard, n_shards, batch_size=64, num_workers=0, cache_dir="clip_cache",
+                  checkpoint_dir="clip_features_parts", backend="torch", num_threads=None):
+    # Extracts one shard of df into its own checkpoint and embedding cache directories, so
+    # shards can run at the same time in separate processes or on separate hosts sharing
+    # a filesystem. Embeddings already in the main cache are read from it rather than
+    # encoded again; new ones go to the shard's cache until merge_shards folds them in.
+    # A done.json marker with the shard's signature is written once every listing is scored.
+    # num_threads caps the model's intra-op threads so concurrent shards don't oversubscribe.
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    df = df[shard_of(df['property_id'], n_shards) == shard]
+    output_dir = shard_dir(checkpoint_dir, shard, n_shards)
+    print(f"Shard {shard} of {n_shards}: {len(df):,} listings, {torch.get_num_threads()} threads")
+
+    encoder = ClipEncoder(backend=backend, num_threads=num_threads)
+    prompt_bank = PromptBank(PROMPTS, encoder)
+    main_cache = EmbeddingCache(cache_dir, encoder.model_name, encoder.pretrained, encoder.backend)
+    cache = EmbeddingCache(shard_dir(cache_dir, shard, n_shards), encoder.model_name, encoder.pretrained,
+                           encoder.backend, base=main_cache)
+    source = ZipImageSource(zip_path)
+    features, errors = extract_clip_features(df, source, encoder, prompt_bank, cache=cache,
+                                             checkpoint=FeatureCheckpoint(output_dir),
+                                             batch_size=batch_size, num_workers=num_workers)
+
+    errors.to_csv(os.path.join(output_dir, "clip_errors.csv"), index=False)
+    signature = shard_signature(df, source, scoring_fingerprint(encoder.model_name, encoder.pretrained,
+                                                                encoder.backend, prompt_bank.prompts))
+    with open(os.path.join(output_dir, "done.json"), "w") as f:
+        json.dump({**signature, "scored": len(features), "errors": len(errors)}, f)
+    return len(features)
+
+
+def run_shards(df, zip_path, n_shards, processes=None, threads_per_worker=None, checkpoint_dir="clip_features_parts",
+               backend="torch", **shard_kwargs):
+    # Runs every shard that has not finished over its current listings and images in a pool
+    # of `processes` worker processes, each pinned to threads_per_worker torch threads (the
+    # cores split evenly between the workers by default). Workers are spawned, not forked,
+    # so none inherits the parent's torch thread pool.
+    shards = shard_of(df['property_id'], n_shards)
+    source = ZipImageSource(zip_path)
+    fingerprint = scoring_fingerprint(CLIP_MODEL_NAME, CLIP_PRETRAINED, backend, PROMPTS)
+    pending = [shard for shard in range(n_shards)
+               if not shard_done(checkpoint_dir, shard, n_shards,
+                                 shard_signature(df[shards == shard], source, fingerprint))]
+    if not pending:
+        print(f"All {n_shards} shards already extracted")
+        return
+
+    processes = processes or min(len(pending), os.cpu_count() or 1)
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // processes)
+    print(f"Extracting {len(pending)} of {n_shards} shards in {processes} processes "
+          f"with {threads_per_worker} threads each")
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as pool:
+        futures = [pool.submit(extract_shard, df[shards == shard], zip_path, shard, n_shards,
+                               checkpoint_dir=checkpoint_dir, backend=backend, num_threads=threads_per_worker,
+                               **shard_kwargs)
+                   for shard in pending]
+        n_scored = sum(future.result() for future in futures)
+    elapsed = time.perf_counter() - start_time
+    print(f"Scored {n_scored:,} images across {len(pending)} shards in {elapsed:,.1f}s "
+          f"({n_scored / max(elapsed, 1e-9):,.1f} images/sec)")
+
+
+def merge_shards(n_shards, checkpoint_dir="clip_features_parts", cache_dir="clip_cache", backend="torch"):
+    # Features and errors of every shard, once all of them are done. The embeddings the
+    # shards encoded are folded into the main cache, so later runs (sharded or not) and
+    # rescore_from_cache find them there, and the shard caches are removed.
+    missing = [shard for shard in range(n_shards) if not shard_done(checkpoint_dir, shard, n_shards)]
+    if missing:
+        raise RuntimeError(f"shards {missing} of {n_shards} have not finished extracting")
+
+    features, errors, shard_caches = [], [], []
+    main_cache = EmbeddingCache(cache_dir, CLIP_MODEL_NAME, CLIP_PRETRAINED, backend)
+    for shard in range(n_shards):
+        output_dir = shard_dir(checkpoint_dir, shard, n_shards)
+        features.append(FeatureCheckpoint(output_dir).load())
+        errors.append(pd.read_csv(os.path.join(output_dir, "clip_errors.csv")))
+
+        shard_cache = EmbeddingCache(shard_dir(cache_dir, shard, n_shards), CLIP_MODEL_NAME, CLIP_PRETRAINED, backend)
+        new_keys = [key for key in shard_cache.index if key not in main_cache]
+        if new_keys:
+            main_cache.add(new_keys, shard_cache.get_many(new_keys))
+        shard_caches.append(shard_cache.cache_dir)
+    main_cache.flush()
+    for shard_cache_dir in shard_caches:
+        shutil.rmtree(shard_cache_dir, ignore_errors=True)
+        # The shard's own directory goes too, unless another backend's cache is left in it
+        shard_root = os.path.dirname(shard_cache_dir)
+        if os.path.isdir(shard_root) and not os.listdir(shard_root):
+            os.rmdir(shard_root)
+    return pd.concat(features, ignore_index=True), pd.concat(errors, ignore_index=True)
+
+
+def run(df, zip_path="Test_images.zip", batch_size=64, num_workers=None,
+        cache_dir="clip_cache", checkpoint_dir="clip_features_parts", backend="torch",
+        n_shards=1, processes=None, threads_per_worker=None, dedup=False, dedup_max_distance=DEDUP_MAX_DISTANCE):
+    # Images are read straight out of the zip file, so nothing is extracted to disk
+    image_source = ZipImageSource(zip_path)
+    print(f"\nIndexed {len(image_source):,} images in: {zip_path}")
+
+    # Only one listing per group of identical or near-identical photos is encoded
+    listings = df
+    if dedup:
+        dedup_start = time.perf_counter()
+        listings, groups = deduplicate_images(df, image_source, dedup_max_distance, num_workers=num_workers)
+        dedup_seconds = time.perf_counter() - dedup_start
+    extract_start = time.perf_counter()
+
+    if n_shards > 1:
+        # Shards split the listings by property_id and run in parallel worker processes;
+        # each worker decodes its own images, so DataLoader workers default to none
+        run_shards(listings, zip_path, n_shards, processes, threads_per_worker, checkpoint_dir=checkpoint_dir,
+                   backend=backend, batch_size=batch_size, num_workers=num_workers or 0, cache_dir=cache_dir)
+        clip_features, clip_errors = merge_shards(n_shards, checkpoint_dir, cache_dir, backend)
+    else:
+        # Text embeddings for every prompt are computed once here, not per property
+        encoder = ClipEncoder(backend=backend)
+        prompt_bank = PromptBank(PROMPTS, encoder)
+
+        # Embeddings are reused across reruns for unchanged images and an unchanged checkpoint,
+        # and results are committed in chunks so an interrupted run picks up where it stopped;
+        # changed images, another backend or new prompts are scored again
+        embedding_cache = EmbeddingCache(cache_dir, encoder.model_name, encoder.pretrained, encoder.backend)
+        clip_checkpoint = FeatureCheckpoint(checkpoint_dir)
+        clip_features, clip_errors = extract_clip_features(listings, image_source, encoder, prompt_bank,
+                                                           cache=embedding_cache, checkpoint=clip_checkpoint,
+                                                           batch_size=batch_size, num_workers=num_workers)
+
+    if dedup:
+        # Time saved is estimated from this run's seconds per encoded listing
+        n_skipped = len(df) - len(listings)
+        seconds_per_listing = (time.perf_counter() - extract_start) / max(len(listings), 1)
+        print(f"Deduplication skipped {n_skipped:,} of {len(df):,} images: about "
+              f"{n_skipped * seconds_per_listing - dedup_seconds:,.1f}s saved, net of the "
+              f"{dedup_seconds:,.1f}s pre-pass")
+        clip_features = fan_out_scores(clip_features, groups)
+    tables.write_table(clip_features, "clip_features.parquet")
+    print("CLIP features saved.")
+
+    # Images that could not be read or decoded, one row per failure
+    clip_errors.to_csv("clip_errors.csv", index=False)
+
+    # Merge structured and visual features on property_id; checkpoint parts from an
+    # earlier run may hold the ids as text
+    clip_features["property_id"] = clip_features["property_id"].astype(df["property_id"].dtype)
+    merged = pd.merge(df, clip_features, on="property_id", how="left")
+
+    # Save merged result
+    tables.write_table(merged, "merged_with_clip.parquet")
+    print("Merged data saved to 'merged_with_clip.parquet'")
+
+    report.plot_all_clip_score_distributions(merged)
+
+    return merged
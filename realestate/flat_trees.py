@@ -0,0 +1,364 @@
+"""Flattened tree-ensemble inference: RF, GBR, HGB and XGBoost models evaluated as flat node arrays."""
+
+import functools
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+# numba is optional: without it predict() uses the NumPy traversal in apply()
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
+# Rows x trees traversed together; bounds the size of the intermediate index arrays
+TRAVERSAL_BLOCK = 1 << 18
+
+# Batches at least this large are split across threads by the compiled kernel
+JIT_PARALLEL_ROWS = 4096
+
+# Categories a categorical split can tell apart (HistGradientBoostingRegressor's 256-bit bitsets)
+N_CATEGORIES = 256
+
+
+def _predict_trees(X, feature, threshold, children, missing_left, category_start, category_left,
+                   leaf_value, roots, scale, check_missing, out):
+    # Tree by tree, so one tree's nodes stay in cache while every row walks it, and each
+    # row adds its leaf values in tree order exactly as the native predict does
+    for tree in range(roots.shape[0]):
+        for row in prange(X.shape[0]):
+            node = roots[tree]
+            while node >= 0:
+                x = X[row, feature[node]]
+                go_right = 1
+                if category_start[node] >= 0 and not np.isnan(x):
+                    if 0 <= x < N_CATEGORIES:
+                        if category_left[category_start[node] + int(x)]:
+                            go_right = 0
+                    elif missing_left[node]:
+                        go_right = 0
+                elif x <= threshold[node] or (check_missing and np.isnan(x) and missing_left[node]):
+                    go_right = 0
+                node = children[2 * node + go_right]
+            out[row] += scale * leaf_value[~node]
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_kernels():
+    # Small batches use the serial kernel, since starting threads for every tree
+    # costs more than walking it
+    if njit is None:
+        return None
+    return njit(_predict_trees), njit(_predict_trees, parallel=True)
+
+
+class FlatTreeEnsemble:
+    # Every tree of the ensemble in one set of node arrays. Internal nodes are numbered
+    # 0..n_internal-1 across all trees; children are stored in pairs (left, right), and a
+    # negative child ~k points at leaf k. A row goes right when not (x <= threshold), or
+    # when x is missing and the node does not send missing values left. A categorical
+    # split instead looks up category int(x) in its N_CATEGORIES entries of category_left,
+    # starting at category_start (-1 for numeric splits); other values count as missing.
+    def __init__(self, feature, threshold, children, missing_left, leaf_value, roots,
+                 n_features, combine, base=0.0, scale=1.0, feature_names=None,
+                 category_start=None, category_left=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.missing_left = missing_left
+        if category_start is None:
+            category_start = np.full(len(feature), -1, dtype=np.int64)
+            category_left = np.zeros(0, dtype=bool)
+        self.category_start = category_start
+        self.category_left = category_left
+        self.has_categorical = bool((category_start >= 0).any())
+        self.leaf_value = leaf_value
+        self.roots = roots
+        self.n_features = n_features
+        # "mean" (random forest), "sum" (gradient boosting, float64) or "sum_float32" (XGBoost)
+        self.combine = combine
+        self.base = base
+        self.scale = scale
+        self.feature_names = feature_names
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _check_input(self, X):
+        if isinstance(X, pd.DataFrame):
+            if self.feature_names is not None and list(X.columns) != self.feature_names:
+                raise ValueError("X columns do not match the columns the model was trained on")
+            X = X.to_numpy(dtype=np.float32)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"expected {self.n_features} features, got shape {X.shape}")
+        return X
+
+    def apply(self, X):
+        # Leaf index reached in every tree, shape (n_rows, n_trees)
+        X = self._check_input(X)
+        n_rows = len(X)
+        leaves = np.empty((self.n_trees, n_rows), dtype=np.int32)
+        check_missing = self.missing_left is not None and np.isnan(X).any()
+        X_flat = X.ravel()
+        row_offsets = np.arange(0, n_rows * self.n_features, self.n_features, dtype=np.int64)
+
+        # Trees are walked a block at a time, tree-major so neighbouring entries read
+        # neighbouring nodes; entries drop out as soon as they reach a leaf
+        trees_per_block = max(1, min(self.n_trees, TRAVERSAL_BLOCK // max(n_rows, 1)))
+        for start in range(0, self.n_trees, trees_per_block):
+            roots = self.roots[start:start + trees_per_block]
+            node = np.repeat(roots, n_rows)
+            position = np.arange(len(node))
+            row_offset = np.tile(row_offsets, len(roots))
+            # A view, since leaves is tree-major
+            block_leaves = leaves[start:start + len(roots)].ravel()
+
+            while len(node):
+                x = X_flat[row_offset + self.feature[node]]
+                go_right = ~(x <= self.threshold[node])
+                if check_missing:
+                    go_right &= ~(np.isnan(x) & self.missing_left[node])
+                if self.has_categorical:
+                    node_category_start = self.category_start[node]
+                    categorical = (node_category_start >= 0) & ~np.isnan(x)
+                    if categorical.any():
+                        x_cat = x[categorical]
+                        in_range = (x_cat >= 0) & (x_cat < N_CATEGORIES)
+                        code = np.where(in_range, x_cat, 0).astype(np.int64)
+                        go_left = np.where(in_range, self.category_left[node_category_start[categorical] + code],
+                                           self.missing_left[node[categorical]])
+                        go_right[categorical] = ~go_left
+                node = self.children[2 * node + go_right]
+
+                done = node < 0
+                if done.any():
+                    block_leaves[position[done]] = ~node[done]
+                    keep = ~done
+                    node, position, row_offset = node[keep], position[keep], row_offset[keep]
+        return leaves.T
+
+    def predict(self, X, jit=True):
+        kernels = _compiled_kernels() if jit else None
+        if kernels is not None:
+            return self._predict_compiled(kernels, X)
+
+        leaves = self.apply(X)
+        # Accumulate tree by tree in the same order and precision as the native predict
+        if self.combine == "sum_float32":
+            values = self.leaf_value.astype(np.float32)
+            out = np.full(len(leaves), self.base, dtype=np.float32)
+            for tree in range(self.n_trees):
+                out += values[leaves[:, tree]]
+            return out
+
+        out = np.zeros(len(leaves)) if self.combine == "mean" else np.full(len(leaves), self.base)
+        for tree in range(self.n_trees):
+            if self.combine == "mean":
+                out += self.leaf_value[leaves[:, tree]]
+            else:
+                out += self.scale * self.leaf_value[leaves[:, tree]]
+        if self.combine == "mean":
+            out /= self.n_trees
+        return out
+
+    def _predict_compiled(self, kernels, X):
+        X = self._check_input(X)
+        kernel = kernels[1] if len(X) >= JIT_PARALLEL_ROWS else kernels[0]
+        check_missing = self.missing_left is not None and bool(np.isnan(X).any())
+        if self.combine == "sum_float32":
+            out = np.full(len(X), self.base, dtype=np.float32)
+            values, scale = self.leaf_value.astype(np.float32), np.float32(1.0)
+        else:
+            out = np.zeros(len(X)) if self.combine == "mean" else np.full(len(X), self.base)
+            values, scale = self.leaf_value, 1.0 if self.combine == "mean" else self.scale
+
+        kernel(X, self.feature, self.threshold, self.children, self.missing_left, self.category_start,
+               self.category_left, values, self.roots, scale, check_missing, out)
+        if self.combine == "mean":
+            out /= self.n_trees
+        return out
+
+
+def _flatten(trees):
+    # trees: (children_left, children_right, feature, threshold, missing_left, leaf_value)
+    # per tree, with -1 children marking leaves, and optionally a dict of categorical split
+    # node -> N_CATEGORIES goes-left flags. Returns the concatenated flat arrays.
+    features, thresholds, children, missing, values, roots = [], [], [], [], [], []
+    category_starts, category_tables = [], []
+    n_internal = n_leaves = n_category_entries = 0
+    for left, right, feature, threshold, missing_left, leaf_value, *categories in trees:
+        categories = categories[0] if categories else {}
+        internal = np.flatnonzero(left >= 0)
+        leaves = np.flatnonzero(left < 0)
+        new_ids = np.empty(len(left), dtype=np.int64)
+        new_ids[internal] = np.arange(n_internal, n_internal + len(internal))
+        new_ids[leaves] = ~np.arange(n_leaves, n_leaves + len(leaves))
+
+        roots.append(new_ids[0])
+        features.append(feature[internal])
+        thresholds.append(threshold[internal])
+        children.append(np.stack([new_ids[left[internal]], new_ids[right[internal]]], axis=1))
+        missing.append(missing_left[internal])
+        values.append(leaf_value[leaves])
+        category_start = np.full(len(internal), -1, dtype=np.int64)
+        for i, node in enumerate(internal):
+            if node in categories:
+                category_start[i] = n_category_entries
+                category_tables.append(categories[node])
+                n_category_entries += N_CATEGORIES
+        category_starts.append(category_start)
+        n_internal += len(internal)
+        n_leaves += len(leaves)
+
+    return {
+        "feature": np.concatenate(features).astype(np.int64),
+        "threshold": np.concatenate(thresholds).astype(np.float64),
+        "children": np.concatenate(children).astype(np.int32).ravel(),
+        "missing_left": np.concatenate(missing).astype(bool),
+        "leaf_value": np.concatenate(values).astype(np.float64),
+        "roots": np.array(roots, dtype=np.int32),
+        "category_start": np.concatenate(category_starts),
+        "category_left": (np.concatenate(category_tables) if category_tables else np.zeros(0)).astype(bool),
+    }
+
+
+def _sklearn_trees(estimators):
+    for tree in estimators:
+        tree = tree.tree_
+        missing_left = getattr(tree, "missing_go_to_left", None)
+        if missing_left is None:
+            missing_left = np.zeros(tree.node_count, dtype=bool)
+        yield (tree.children_left, tree.children_right, tree.feature, tree.threshold,
+               np.asarray(missing_left, dtype=bool), tree.value[:, 0, 0])
+
+
+def _xgboost_trees(booster, n_trees):
+    model = json.loads(booster.save_raw("json"))
+    gbtree = model["learner"]["gradient_booster"]
+    if gbtree["name"] != "gbtree":
+        raise ValueError(f"only gbtree boosters can be flattened, not {gbtree['name']}")
+    base_score = float(model["learner"]["learner_model_param"]["base_score"].strip("[]"))
+
+    trees = []
+    for tree in gbtree["model"]["trees"][:n_trees]:
+        left = np.array(tree["left_children"], dtype=np.int64)
+        right = np.array(tree["right_children"], dtype=np.int64)
+        split = np.array(tree["split_conditions"], dtype=np.float32)
+        # XGBoost goes left when x < split in float32, which for float32 inputs is the
+        # same as x <= the next float32 below split
+        threshold = np.nextafter(split, np.float32(-np.inf)).astype(np.float64)
+        trees.append((left, right, np.array(tree["split_indices"], dtype=np.int64), threshold,
+                      np.array(tree["default_left"], dtype=bool), split.astype(np.float64)))
+    return trees, base_score
+
+
+def _bit(bitsets, row, value):
+    return bool((bitsets[row, value // 32] >> np.uint32(value % 32)) & 1)
+
+
+def _hist_gradient_boosting_trees(model):
+    # The predictors' node arrays. With categorical features, the model's _preprocessor
+    # moves them to the front and ordinal-encodes them, so split features are mapped back
+    # to the input columns and each categorical split becomes a goes-left flag per raw
+    # category: left for the categories in its raw_left_cat_bitsets, right for the other
+    # categories seen in training, and unseen ones treated as missing, as in the model's
+    # own predictor
+    known_bitsets, feature_rows = model._bin_mapper.make_known_categories_bitsets()
+    if model._preprocessor is None:
+        input_column, encoded_categories = np.arange(model.n_features_in_), {}
+    else:
+        categorical = np.asarray(model.is_categorical_, dtype=bool)
+        input_column = np.concatenate([np.flatnonzero(categorical), np.flatnonzero(~categorical)])
+        encoder = model._preprocessor.named_transformers_["encoder"]
+        encoded_categories = dict(enumerate(encoder.categories_))
+
+    for (predictor,) in model._predictors:
+        nodes = predictor.nodes
+        leaf = nodes["is_leaf"].astype(bool)
+        categories = {}
+        for node in np.flatnonzero(nodes["is_categorical"].astype(bool) & ~leaf):
+            feature = nodes["feature_idx"][node]
+            bitset_row, known_row = nodes["bitset_idx"][node], feature_rows[feature]
+            goes_left = np.full(N_CATEGORIES, bool(nodes["missing_go_to_left"][node]))
+            for code, value in enumerate(encoded_categories[feature]):
+                if 0 <= value < N_CATEGORIES and value == int(value):
+                    if _bit(predictor.raw_left_cat_bitsets, bitset_row, code):
+                        goes_left[int(value)] = True
+                    elif _bit(known_bitsets, known_row, code):
+                        goes_left[int(value)] = False
+            categories[node] = goes_left
+        left = np.where(leaf, -1, nodes["left"].astype(np.int64))
+        right = np.where(leaf, -1, nodes["right"].astype(np.int64))
+        yield (left, right, input_column[nodes["feature_idx"]], nodes["num_threshold"],
+               nodes["missing_go_to_left"].astype(bool), nodes["value"], categories)
+
+
+def flatten_model(model):
+    # Build the flat representation of a fitted RandomForestRegressor,
+    # GradientBoostingRegressor, HistGradientBoostingRegressor or XGBRegressor
+    from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+    from xgboost import XGBRegressor
+
+    feature_names = list(getattr(model, "feature_names_in_", [])) or None
+    if isinstance(model, RandomForestRegressor):
+        arrays = _flatten(_sklearn_trees(model.estimators_))
+        return FlatTreeEnsemble(**arrays, n_features=model.n_features_in_, combine="mean",
+                                feature_names=feature_names)
+
+    if isinstance(model, GradientBoostingRegressor):
+        if model.loss not in ("squared_error", "absolute_error", "huber", "quantile"):
+            raise ValueError(f"unsupported GradientBoostingRegressor loss {model.loss!r}")
+        arrays = _flatten(_sklearn_trees(model.estimators_[:, 0]))
+        init = model._raw_predict_init(np.zeros((1, model.n_features_in_), dtype=np.float32))[0, 0]
+        return FlatTreeEnsemble(**arrays, n_features=model.n_features_in_, combine="sum",
+                                base=float(init), scale=model.learning_rate, feature_names=feature_names)
+
+    if isinstance(model, HistGradientBoostingRegressor):
+        # Thresholds are compared in float64 against the float32 inputs, so predictions
+        # match for float32 features such as the bundles' preprocessing produces
+        if model.loss != "squared_error":
+            raise ValueError(f"unsupported HistGradientBoostingRegressor loss {model.loss!r}")
+        arrays = _flatten(_hist_gradient_boosting_trees(model))
+        return FlatTreeEnsemble(**arrays, n_features=model.n_features_in_, combine="sum",
+                                base=float(model._baseline_prediction[0, 0]), feature_names=feature_names)
+
+    if isinstance(model, XGBRegressor):
+        booster = model.get_booster()
+        # predict() stops at the best iteration when the model was early stopped
+        n_trees = model.best_iteration + 1 if hasattr(model, "best_iteration") else booster.num_boosted_rounds()
+        trees, base_score = _xgboost_trees(booster, n_trees)
+        arrays = _flatten(trees)
+        return FlatTreeEnsemble(**arrays, n_features=model.n_features_in_, combine="sum_float32",
+                                base=np.float32(base_score), feature_names=feature_names)
+
+    raise TypeError(f"cannot flatten a {type(model).__name__}")
+
+
+def benchmark(models, X, batch_sizes=(1, 100, 1000, None), repeats=3):
+    # Rows/sec of native predict against the flattened ensemble for each model, and the
+    # largest absolute difference between their predictions. None means all of X.
+    rows = []
+    for name, model in models.items():
+        flat = flatten_model(model)
+        max_diff = float(np.max(np.abs(flat.predict(X) - model.predict(X))))
+        for batch_size in batch_sizes:
+            batch = X.iloc[:batch_size] if batch_size else X
+            timings = {}
+            for backend, predict in (("native", model.predict), ("flat", flat.predict)):
+                elapsed = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    predict(batch)
+                    elapsed.append(time.perf_counter() - start)
+                timings[backend] = len(batch) / min(elapsed)
+            rows.append({"model": name, "rows": len(batch), "native rows/sec": timings["native"],
+                         "flat rows/sec": timings["flat"], "speedup": timings["flat"] / timings["native"],
+                         "max abs diff": max_diff})
+
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False, float_format=lambda v: f"{v:,.3g}"))
+    return results
@@ -0,0 +1,392 @@
+"""Preprocessing stage: cleaning, outlier capping, scaling and target encoding."""
+
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import StandardScaler
+
+from . import report
+
+LISTING_COLUMNS = ["property_id", "street_address", "city", "city_encoded",
+                   "num_bedrooms", "num_bathrooms", "square_feet", "price",
+                   "image_filename"]
+
+# Dtypes the listings are parsed into. Every count and price in the data is a whole
+# number well below 2**24, so float32 holds them exactly.
+LISTING_SCHEMA = {
+    "property_id": "int32",
+    "street_address": "object",
+    "city": "category",
+    "city_encoded": "int32",
+    "num_bedrooms": "float32",
+    "num_bathrooms": "float32",
+    "square_feet": "float32",
+    "price": "float32",
+    "image_filename": "object",
+}
+
+# For testing purposes according to computational limits, the pipeline extracts and
+# trains on the first SUBSET_ROWS listings, as the original notebook did
+SUBSET_ROWS = 12517
+
+# Drop irrelevant columns
+COLUMNS_TO_DROP = [
+    "property_id",
+    "street_address",
+    "image_filename",
+    "city_encoded"
+]
+
+# Object columns converted to float
+COLUMNS_TO_CONVERT = ['num_bedrooms', 'num_bathrooms', 'square_feet', 'price']
+
+SCORE_FEATURES = ['garage_present_score', 'greenery_score', 'window_count_score', 'driveway_yard_score']
+
+# The only columns of the merged table this stage reads
+MERGED_COLUMNS = ['city'] + COLUMNS_TO_CONVERT + SCORE_FEATURES
+
+# Define features and their respective cap percentiles according to outliers inspection
+CAP_RULES = {
+    'num_bedrooms': 0.95,
+    'num_bathrooms': 0.90,
+    'square_feet': 0.90
+}
+
+# Define clipping and capping percentiles for score features
+SCORE_RULES = {
+    'garage_present_score': (0.05, 0.95),      # clip lower + cap upper
+    'greenery_score': (0.01, 0.99),            # very minor, almost none
+    'window_count_score': (0.20, 0.99),        # more aggressive lower clipping
+    'driveway_yard_score': (0.01, 0.99)        # mild both sides
+}
+
+# Cap price outliers at 85th percentile
+PRICE_CAP_PERCENTILE = 0.85
+
+# The target-encoded city feature. A city's average price is blended with the overall
+# average as if it had CITY_SMOOTHING extra listings at that price, so cities with only
+# a handful of listings are not encoded from one or two prices.
+CITY_FEATURE = 'city_avg_price'
+CITY_SMOOTHING = 10
+
+# With city_encoding="categorical" the city column is instead the index of the city among
+# the MAX_CITY_CATEGORIES most common training cities (NaN for the rest), for models that
+# split on categories natively. HistGradientBoosting takes at most 255 categories.
+CITY_CODE_FEATURE = 'city_code'
+MAX_CITY_CATEGORIES = 255
+
+
+def _to_float(column):
+    # Typed columns are only widened; text columns (e.g. from an older merged CSV) have
+    # thousands separators and whitespace removed first
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype('float64')
+    return pd.to_numeric(column.astype(str).str.replace(",", "").str.strip(), errors='coerce')
+
+
+def load_listings(path='Property_listings.csv', engine="c"):
+    # Import the dataset that we will work with, parsed straight into LISTING_SCHEMA.
+    # The header row names the columns; columns missing from the file (e.g. price for
+    # new listings) are skipped.
+    numeric = {col: dtype for col, dtype in LISTING_SCHEMA.items() if dtype not in ("object", "category")}
+    try:
+        if engine == "pyarrow":
+            # The pyarrow engine has no thousands option, so numbers are parsed as
+            # inferred and any column that comes back as text is converted below
+            df = pd.read_csv(path, engine="pyarrow",
+                             dtype={col: dtype for col, dtype in LISTING_SCHEMA.items() if col not in numeric})
+        else:
+            df = pd.read_csv(path, dtype=LISTING_SCHEMA, thousands=",")
+    except ValueError:
+        # Some value does not parse as a number: read the numeric columns as text and
+        # coerce them, leaving NaN for clean_merged to drop
+        df = pd.read_csv(path, dtype={col: (str if col in numeric else dtype) for col, dtype in LISTING_SCHEMA.items()})
+
+    for col, dtype in numeric.items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = _to_float(df[col])
+            if not (dtype.startswith("int") and df[col].isna().any()):
+                df[col] = df[col].astype(dtype)
+    return df
+
+
+def _load_listings_untyped(path):
+    # The original loader and conversion, kept for benchmark_loading
+    df = pd.read_csv(path, names=LISTING_COLUMNS).iloc[1:].reset_index(drop=True)
+    for col in COLUMNS_TO_CONVERT:
+        df[col] = pd.to_numeric(df[col].astype(str).str.replace(",", "").str.strip(), errors='coerce')
+    return df
+
+
+LOADERS = {
+    "untyped": _load_listings_untyped,
+    "typed": load_listings,
+    "typed_pyarrow": lambda path: load_listings(path, engine="pyarrow"),
+}
+
+
+def _measure_loader(name, path):
+    import resource
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    df = LOADERS[name](path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, (peak - baseline) / 1024, df.memory_usage(deep=True).sum() / 1e6
+
+
+def benchmark_loading(path='Property_listings.csv', repeats=3):
+    # Each measurement runs in a fresh process so the peak RSS growth belongs to that load alone
+    import multiprocessing
+
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name in LOADERS:
+            runs = [pool.apply(_measure_loader, (name, path)) for _ in range(repeats)]
+            rows.append({"loader": name,
+                         "load time (ms)": min(run[0] for run in runs) * 1000,
+                         "peak RSS growth (MB)": min(run[1] for run in runs),
+                         "frame size (MB)": runs[0][2]})
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False, float_format=lambda v: f"{v:,.2f}"))
+    return results
+
+
+def smoothed_city_means(sums, counts, prior, smoothing=CITY_SMOOTHING):
+    return (sums + smoothing * prior) / (counts + smoothing)
+
+
+class FoldCityEncoding:
+    # Fold-local city target encoding for one set of CV folds. A single bincount over
+    # (city, fold) pairs gives the price sum and count of every city in every fold; a
+    # fold's training statistics are the totals minus its own rows, so each fold's
+    # encoding is computed without the prices it is scored on.
+    def __init__(self, cities, y, folds, smoothing=CITY_SMOOTHING):
+        self.codes_, _ = pd.factorize(np.asarray(cities))
+        y = np.asarray(y, dtype=np.float64)
+        self.folds = [(np.asarray(train_idx), np.asarray(test_idx)) for train_idx, test_idx in folds]
+        n_cities, n_folds = self.codes_.max() + 1, len(self.folds)
+
+        fold_of_row = np.empty(len(y), dtype=np.int64)
+        for k, (_, test_idx) in enumerate(self.folds):
+            fold_of_row[test_idx] = k
+        cell = self.codes_ * n_folds + fold_of_row
+        sums = np.bincount(cell, weights=y, minlength=n_cities * n_folds).reshape(n_cities, n_folds)
+        counts = np.bincount(cell, minlength=n_cities * n_folds).reshape(n_cities, n_folds)
+
+        train_sums = sums.sum(axis=1, keepdims=True) - sums
+        train_counts = counts.sum(axis=1, keepdims=True) - counts
+        # Each fold's own mean price is the prior, and the value for its unseen cities
+        prior = train_sums.sum(axis=0) / train_counts.sum(axis=0)
+        # (n_cities, n_folds)
+        self.values_ = smoothed_city_means(train_sums, train_counts, prior, smoothing)
+
+    def fold_frame(self, X, k, column=CITY_FEATURE):
+        # X with the city column encoded from fold k's training rows, for every row
+        return X.assign(**{column: self.values_[self.codes_, k].astype(X[column].dtype)})
+
+
+def clean_merged(merged):
+    # The merged table may already have been read without the dropped columns
+    df_cleaned = merged.drop(columns=[col for col in COLUMNS_TO_DROP if col in merged.columns])
+
+    # Convert the structured columns to float
+    for col in COLUMNS_TO_CONVERT:
+        df_cleaned[col] = _to_float(df_cleaned[col])
+
+    # Convert 'city' to categorical
+    df_cleaned['city'] = df_cleaned['city'].astype(str)
+    df_cleaned['city'] = pd.Categorical(df_cleaned['city'])
+
+    # Drop rows with failed conversions
+    df_cleaned.dropna(subset=COLUMNS_TO_CONVERT, inplace=True)
+    return df_cleaned
+
+
+class ListingPreprocessor(TransformerMixin, BaseEstimator):
+    # Percentile caps and clips, the price cap, standard scaling and the city target
+    # encoding, fitted once and applied to any frame of listings in a single NumPy pass.
+    # As a scikit-learn transformer it can sit in a Pipeline in front of a model and be
+    # cross-validated or saved with it. city_encoding picks the last column: "target"
+    # (city_avg_price) or "categorical" (city_code); both are fitted, so it can be
+    # switched with set_params after fitting.
+    def __init__(self, cap_rules=CAP_RULES, score_rules=SCORE_RULES,
+                 price_cap_percentile=PRICE_CAP_PERCENTILE, city_smoothing=CITY_SMOOTHING,
+                 city_encoding="target"):
+        self.cap_rules = cap_rules
+        self.score_rules = score_rules
+        self.price_cap_percentile = price_cap_percentile
+        self.city_smoothing = city_smoothing
+        self.city_encoding = city_encoding
+
+    def _numeric_matrix(self, X):
+        # One float64 matrix of the numeric feature columns; text columns (e.g. JSON
+        # request values) are converted first, typed ones are taken as they are
+        frame = X[self.feature_columns_]
+        text_columns = [col for col in self.feature_columns_ if not pd.api.types.is_numeric_dtype(frame[col])]
+        if text_columns:
+            frame = frame.assign(**{col: _to_float(frame[col]) for col in text_columns})
+        return frame.to_numpy(dtype=np.float64)
+
+    def fit(self, X, y=None):
+        # Numeric features in the order they appear; price is the target, city is encoded
+        self.feature_columns_ = [col for col in X.columns
+                                 if col not in ['city', 'price'] + COLUMNS_TO_DROP
+                                 and pd.api.types.is_numeric_dtype(X[col])]
+        values = self._numeric_matrix(X)
+
+        # Lower and upper bound per column: caps only have an upper bound
+        self.lower_ = np.full(len(self.feature_columns_), -np.inf)
+        self.upper_ = np.full(len(self.feature_columns_), np.inf)
+        self.caps_, self.score_bounds_ = {}, {}
+        for feature, percentile in self.cap_rules.items():
+            i = self.feature_columns_.index(feature)
+            self.upper_[i] = self.caps_[feature] = np.nanquantile(values[:, i], percentile)
+        for feature, (low_pct, high_pct) in self.score_rules.items():
+            i = self.feature_columns_.index(feature)
+            self.lower_[i], self.upper_[i] = np.nanquantile(values[:, i], [low_pct, high_pct])
+            self.score_bounds_[feature] = (self.lower_[i], self.upper_[i])
+        np.clip(values, self.lower_, self.upper_, out=values)
+
+        scaler = StandardScaler().fit(values)
+        self.mean_, self.scale_ = scaler.mean_, scaler.scale_
+        # Running count, mean and variance per column, which partial_fit keeps updating
+        self.n_samples_seen_ = np.broadcast_to(scaler.n_samples_seen_, self.mean_.shape).astype(np.float64)
+        self.running_mean_, self.running_var_ = scaler.mean_.copy(), scaler.var_.copy()
+
+        # Target encode city using the smoothed average capped price
+        price = _to_float(X['price'] if y is None else pd.Series(y, index=X.index))
+        self.price_cap_ = price.quantile(self.price_cap_percentile)
+        price = self.transform_target(price)
+        city_prices = price.groupby(X['city'].astype(str)).agg(['sum', 'count'])
+        self.price_sum_, self.price_count_ = float(price.sum()), int(price.count())
+        self.city_price_sums_ = city_prices['sum'].to_dict()
+        self.city_price_counts_ = city_prices['count'].to_dict()
+        city_means, self.default_city_price_ = self.running_city_prices()
+        self.city_price_map_ = city_means.to_dict()
+        most_common = city_prices['count'].sort_values(ascending=False, kind='stable')
+        self.city_categories_ = list(most_common.index[:MAX_CITY_CATEGORIES])
+        return self
+
+    def running_city_prices(self):
+        # Smoothed average capped price per city from the running sums and counts, and
+        # the average capped price over every city as the prior
+        prior = self.price_sum_ / self.price_count_
+        sums = pd.Series(self.city_price_sums_, dtype=np.float64)
+        counts = pd.Series(self.city_price_counts_, dtype=np.float64)
+        return smoothed_city_means(sums, counts, prior, self.city_smoothing), prior
+
+    def partial_fit(self, X, y=None):
+        # Folds a batch of new listings into the running statistics: the per-column count,
+        # mean and variance, and the price sums and counts behind the city encoding. What
+        # transform applies stays as fitted (caps, mean_ and scale_, and the encoding of
+        # every city already seen), as the fitted models split on exactly those values;
+        # only cities seen for the first time get an encoding. They all move on a full
+        # refit, which refresh triggers once the running statistics drift too far.
+        if not hasattr(self, "mean_"):
+            return self.fit(X, y)
+        values = self._numeric_matrix(X)
+        np.clip(values, self.lower_, self.upper_, out=values)
+        present = ~np.isnan(values)
+        n_batch = present.sum(axis=0).astype(np.float64)
+        batch_mean = np.divide(np.nansum(values, axis=0), n_batch, out=np.zeros_like(n_batch), where=n_batch > 0)
+        batch_m2 = np.nansum(np.where(present, values - batch_mean, 0.0) ** 2, axis=0)
+        # Chan et al.'s pairwise update of the mean and the sum of squared deviations
+        total = self.n_samples_seen_ + n_batch
+        delta = batch_mean - self.running_mean_
+        m2 = (self.running_var_ * self.n_samples_seen_ + batch_m2
+              + delta ** 2 * self.n_samples_seen_ * n_batch / np.maximum(total, 1))
+        self.running_mean_ = self.running_mean_ + delta * n_batch / np.maximum(total, 1)
+        self.running_var_ = m2 / np.maximum(total, 1)
+        self.n_samples_seen_ = total
+
+        price = self.transform_target(_to_float(X['price'] if y is None else pd.Series(y, index=X.index)))
+        city_prices = price.groupby(X['city'].astype(str)).agg(['sum', 'count'])
+        self.price_sum_ += float(price.sum())
+        self.price_count_ += int(price.count())
+        for city, row in city_prices.iterrows():
+            self.city_price_sums_[city] = self.city_price_sums_.get(city, 0.0) + row['sum']
+            self.city_price_counts_[city] = self.city_price_counts_.get(city, 0) + int(row['count'])
+        city_means, _ = self.running_city_prices()
+        self.city_price_map_.update({city: value for city, value in city_means.items()
+                                     if city not in self.city_price_map_})
+        return self
+
+    def transform_target(self, y):
+        return np.minimum(y, self.price_cap_)
+
+    def _city_values(self, city, mapping, default):
+        # Look up each category once and index by the codes, instead of mapping every row
+        if not isinstance(city.dtype, pd.CategoricalDtype):
+            city = city.astype(str).astype('category')
+        category_values = (pd.Series(mapping, dtype=np.float64)
+                           .reindex(city.cat.categories.astype(str))
+                           .fillna(default)
+                           .to_numpy(dtype=np.float64))
+        codes = city.cat.codes.to_numpy()
+        return np.where(codes >= 0, category_values[codes], default)
+
+    def city_codes(self, city):
+        # Index of each city in city_categories_, NaN for rare or unseen cities
+        return self._city_values(pd.Series(city), {name: i for i, name in enumerate(self.city_categories_)}, np.nan)
+
+    def _city_column(self, city):
+        if self.city_encoding == "categorical":
+            return self.city_codes(city)
+        return self._city_values(city, self.city_price_map_, self.default_city_price_)
+
+    def transform(self, X):
+        values = self._numeric_matrix(X)
+        np.clip(values, self.lower_, self.upper_, out=values)
+        values -= self.mean_
+        values /= self.scale_
+
+        features = np.empty((len(values), len(self.feature_columns_) + 1), dtype=np.float32)
+        features[:, :-1] = values
+        features[:, -1] = self._city_column(X['city'])
+        return features
+
+    def get_feature_names_out(self, input_features=None):
+        city_feature = CITY_CODE_FEATURE if self.city_encoding == "categorical" else CITY_FEATURE
+        return np.array(self.feature_columns_ + [city_feature], dtype=object)
+
+    def transform_frame(self, X):
+        # transform() with the feature names, as the models are fitted on a DataFrame
+        return pd.DataFrame(self.transform(X), columns=self.get_feature_names_out(), index=X.index)
+
+
+def run(merged):
+    merged.info()
+    report.plot_missing_values(merged)
+
+    df_cleaned = clean_merged(merged)
+    print(df_cleaned.dtypes)
+    print("\n --------------------------------------------------------------------")
+    print(df_cleaned.head())
+
+    # Features to inspect
+    report.plot_outlier_boxplots(merged, COLUMNS_TO_CONVERT, "Outlier Inspection of Structured Features")
+    report.plot_outlier_boxplots(merged, SCORE_FEATURES, "Outlier Inspection of CLIP Extracted Features")
+
+    # Every threshold, the scaler and the city map are fitted into one transformer,
+    # which is saved with the model so new listings are transformed the same way
+    preprocessor = ListingPreprocessor().fit(df_cleaned)
+    for feature, percentile in CAP_RULES.items():
+        print(f"Capped {feature} at {percentile*100:.0f}th percentile: {preprocessor.caps_[feature]:,.2f}")
+    for feature, (low_pct, high_pct) in SCORE_RULES.items():
+        print(f"Clipped {feature} between {low_pct*100:.0f}th and {high_pct*100:.0f}th percentiles")
+    print(f"Price values above ${preprocessor.price_cap_:,.0f} have been capped.")
+
+    # Final split
+    X = preprocessor.transform_frame(df_cleaned)
+    y = preprocessor.transform_target(df_cleaned["price"])
+    # City of every row, so cross-validation can re-encode city_avg_price inside each fold
+    cities = df_cleaned['city']
+    report.plot_price_violin(merged, pd.DataFrame({"price": y}))
+
+    report.plot_correlation_heatmap(X.assign(price=y))
+    return X, y, cities, preprocessor
@@ -0,0 +1,234 @@
+"""Incremental refresh: fold newly arrived listings into the latest bundle without a full retrain."""
+
+import copy
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from . import preprocess
+from .bundle import BUNDLE_DIR, load_bundle, read_listings, save_bundle
+from .tables import append_table, read_table, write_table
+from .train import MODEL_FAMILIES
+
+# Rounds (or trees) added per refresh, in proportion to the new rows' share of all training
+# rows, so the ensemble grows at the rate the data does, but never fewer than this
+MIN_REFRESH_ROUNDS = 10
+# History rows replayed with each new row: the added trees fit the new listings together
+# with a sample of the old ones rather than the new batch alone, and the refresh still
+# costs time in proportion to the batch rather than to the history
+REPLAY_RATIO = 10
+# A refresh becomes a full retrain when any check goes over its threshold:
+#   mae_ratio     - the current model's MAE on the new listings over its CV MAE
+#   batch_shift   - distance of a feature's mean in the new batch from its running mean, in SDs
+#   scaling_shift - distance of a feature's running mean from the mean the model was fitted with, in SDs
+#   city_shift    - listing-weighted mean distance of the running city prices from the encoded ones,
+#                   as a fraction of the average price
+#   warm_start    - 1 for a model family that can't be continued, which is always retrained
+#   replay_mae_ratio - the refreshed model's MAE on the replayed history over the current model's,
+#                   checked after the new rounds are added so a refresh that unlearns the history
+#                   is never saved
+DRIFT_THRESHOLDS = {"mae_ratio": 1.25, "batch_shift": 0.5, "scaling_shift": 0.25, "city_shift": 0.05,
+                    "warm_start": 0, "replay_mae_ratio": 1.1}
+# The checks on the new batch alone are too noisy below this many rows and are skipped
+MIN_DRIFT_ROWS = 30
+# HistGradientBoostingRegressor refits its category encoding and bins on every fit, warm
+# start included, so stages added on a batch and a replay sample that lack some cities
+# would send those cities down the wrong branches of the existing trees
+FULL_RETRAIN_FAMILIES = {"hgb"}
+
+
+def extra_rounds(bundle, n_new):
+    family = bundle["family"]
+    size = bundle["model"].get_params()[MODEL_FAMILIES[family].get("size_param", "n_estimators")]
+    return max(MIN_REFRESH_ROUNDS, int(round(size * n_new / bundle["n_train_rows"])))
+
+
+def continue_training(model, family, X, y, rounds):
+    # XGBoost boosts `rounds` more rounds on top of the existing booster; the scikit-learn
+    # ensembles grow by warm start, gradient boosting with stages fitted to the current
+    # residuals of X and the forest with trees on bootstraps of X
+    size_param = MODEL_FAMILIES[family].get("size_param", "n_estimators")
+    size = model.get_params()[size_param]
+    if family == "xgb":
+        import xgboost
+
+        # The booster is continued directly rather than through fit, which for the
+        # early-stopping models of --search halving would hold out part of X again. An
+        # early-stopped booster is cut at its best iteration first (predict ignored the
+        # rounds after it) and loses best_iteration, so predict uses every round.
+        booster = model.get_booster()
+        if booster.attr("best_iteration") is not None:
+            booster = booster[:int(booster.attr("best_iteration")) + 1]
+            booster.set_attr(best_iteration=None, best_score=None)
+        booster = xgboost.train(model.get_xgb_params(), xgboost.DMatrix(X, label=y), rounds, xgb_model=booster)
+        model._Booster = booster
+        model.set_params(n_estimators=booster.num_boosted_rounds())
+    else:
+        model.set_params(warm_start=True, **{size_param: size + rounds}).fit(X, y)
+    return model
+
+
+def drift_checks(bundle, batch, min_rows=MIN_DRIFT_ROWS):
+    # Checks of the cleaned batch against the bundle as it was before the refresh
+    preprocessing = bundle["preprocessing"]
+    rows = []
+    if len(batch) >= min_rows:
+        features = preprocessing.transform_frame(batch)
+        y = preprocessing.transform_target(batch["price"]).to_numpy()
+        mae = np.mean(np.abs(bundle["model"].predict(features) - y))
+        rows.append({"check": "mae_ratio", "feature": "price", "value": mae / bundle["metrics"]["mae"]})
+
+        values = preprocessing._numeric_matrix(batch)
+        np.clip(values, preprocessing.lower_, preprocessing.upper_, out=values)
+        shift = np.abs(np.nanmean(values, axis=0) - preprocessing.running_mean_) / np.sqrt(preprocessing.running_var_)
+        rows += [{"check": "batch_shift", "feature": feature, "value": value}
+                 for feature, value in zip(preprocessing.feature_columns_, shift)]
+    return rows
+
+
+def running_checks(preprocessing):
+    # How far the running statistics have moved from the scaling and city encoding the
+    # model was fitted with, which transform keeps applying until the next full retrain
+    shift = np.abs(preprocessing.running_mean_ - preprocessing.mean_) / preprocessing.scale_
+    rows = [{"check": "scaling_shift", "feature": feature, "value": value}
+            for feature, value in zip(preprocessing.feature_columns_, shift)]
+    city_means, _ = preprocessing.running_city_prices()
+    encoded = pd.Series(preprocessing.city_price_map_).reindex(city_means.index)
+    counts = pd.Series(preprocessing.city_price_counts_).reindex(city_means.index)
+    city_shift = np.average(np.abs(city_means - encoded), weights=counts) / preprocessing.default_city_price_
+    rows.append({"check": "city_shift", "feature": preprocess.CITY_FEATURE, "value": city_shift})
+    return rows
+
+
+def trainable_rows(merged):
+    # Only listings with every feature and a price are used, as the model can't take missing scores
+    return preprocess.clean_merged(merged).dropna(subset=preprocess.SCORE_FEATURES)
+
+
+def check_table(rows, thresholds):
+    checks = pd.DataFrame(rows, columns=["check", "feature", "value"])
+    checks["threshold"] = checks["check"].map(thresholds)
+    checks["drifted"] = checks["value"] > checks["threshold"]
+    return checks
+
+
+def refresh_bundle(bundle, batch, history, thresholds=DRIFT_THRESHOLDS, min_rows=MIN_DRIFT_ROWS,
+                   replay_ratio=REPLAY_RATIO, random_state=0):
+    # batch is the new merged listings, history the ones the bundle has already seen.
+    # Returns the refreshed bundle, or None when the data has drifted past a threshold, the
+    # model can't be continued or the refresh made it worse on the replayed history, and
+    # it needs a full retrain, together with the checks as a DataFrame and the listings
+    # of the batch that can be trained on, with their index in batch.
+    start_time = time.perf_counter()
+    batch = trainable_rows(batch)
+    if batch.empty:
+        raise ValueError("none of the new listings has every feature and a price")
+    preprocessing = copy.deepcopy(bundle["preprocessing"]).partial_fit(batch)
+    family = bundle["family"]
+    rows = drift_checks(bundle, batch, min_rows) + running_checks(preprocessing)
+    if family in FULL_RETRAIN_FAMILIES:
+        rows.append({"check": "warm_start", "feature": family, "value": 1.0})
+    checks = check_table(rows, thresholds)
+    if checks["drifted"].any():
+        return None, checks, batch
+
+    # The new listings plus a random sample of the history, with the cities seen for the first time encoded
+    replay = history.sample(n=min(len(history), replay_ratio * len(batch)), random_state=random_state)
+    replay = trainable_rows(replay)
+    train_rows = pd.concat([batch, replay], ignore_index=True)
+    X = preprocessing.transform_frame(train_rows)
+    y = preprocessing.transform_target(train_rows["price"]).to_numpy()
+
+    rounds = extra_rounds(bundle, len(batch))
+    model = continue_training(copy.deepcopy(bundle["model"]), family, X, y, rounds)
+
+    # The replayed listings are scored by both models before anything is saved
+    if len(replay):
+        X_replay, y_replay = X.iloc[len(batch):], y[len(batch):]
+        before = np.mean(np.abs(bundle["model"].predict(X_replay) - y_replay))
+        after = np.mean(np.abs(model.predict(X_replay) - y_replay))
+        checks = check_table(checks[["check", "feature", "value"]].to_dict("records")
+                             + [{"check": "replay_mae_ratio", "feature": "price", "value": after / before}],
+                             thresholds)
+        if checks["drifted"].any():
+            return None, checks, batch
+    elapsed = time.perf_counter() - start_time
+
+    refreshed = dict(bundle, model=model, preprocessing=preprocessing,
+                     created_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                     n_train_rows=bundle["n_train_rows"] + len(batch))
+    refreshed["refreshes"] = bundle["refreshes"] + [{
+        "created_at": refreshed["created_at"],
+        "new_rows": len(batch),
+        "replayed_rows": len(replay),
+        "rounds_added": rounds,
+        "seconds": elapsed,
+    }]
+    unit = "trees" if family == "rf" else "rounds"
+    print(f"Added {rounds} {MODEL_FAMILIES[family]['name']} {unit} on {len(batch):,} new and "
+          f"{len(replay):,} replayed listings in {elapsed:,.2f}s")
+    return refreshed, checks, batch
+
+
+def pending_history_path(history_path):
+    # The training history plus listings that still wait for a full retrain
+    root, ext = os.path.splitext(history_path)
+    return f"{root}.pending{ext}"
+
+
+def run(listings_path, images=None, history_path="merged_with_clip.parquet", bundle_dir=BUNDLE_DIR,
+        clip_batch_size=64, num_workers=None, clip_backend="torch", thresholds=DRIFT_THRESHOLDS):
+    # Finds the listings not yet in the training history, scores only those with CLIP and
+    # refreshes the latest bundle with them; the ones it trained on are appended to the
+    # history once the refreshed bundle is saved, so a listing only counts as seen when a
+    # model has trained on it, and listings missing a feature or a price are tried again
+    # next time. When the data has drifted, the history with the new listings is written
+    # to a pending table instead and its path returned, for the pipeline to be rerun on it.
+    from .bundle import PricePredictor
+
+    start_time = time.perf_counter()
+    bundle = load_bundle(bundle_dir)
+    history = read_table(history_path)
+    listings = read_listings(listings_path)
+    new = listings[~listings["property_id"].isin(history["property_id"])].reset_index(drop=True)
+    print(f"{len(new):,} of {len(listings):,} listings are new; {len(history):,} already in '{history_path}'")
+    if new.empty:
+        return None
+
+    missing_scores = [col for col in preprocess.SCORE_FEATURES if col not in new.columns]
+    if missing_scores:
+        if images is None:
+            raise ValueError(f"{listings_path} has no {', '.join(missing_scores)} columns; "
+                             "pass the listing images to score them with CLIP")
+        from .extract import DirectoryImageSource, ZipImageSource
+        image_source = DirectoryImageSource(images) if os.path.isdir(images) else ZipImageSource(images)
+        new = PricePredictor(bundle).add_clip_scores(
+            new.drop(columns=[col for col in preprocess.SCORE_FEATURES if col in new.columns]), image_source,
+            batch_size=clip_batch_size, num_workers=num_workers, clip_backend=clip_backend)
+
+    new = new[history.columns.intersection(new.columns)]
+    if trainable_rows(new[preprocess.MERGED_COLUMNS]).empty:
+        print("None of the new listings has every feature and a price; nothing to refresh")
+        return None
+    refreshed, checks, trained = refresh_bundle(bundle, new[preprocess.MERGED_COLUMNS],
+                                                history[preprocess.MERGED_COLUMNS], thresholds)
+    print(checks.to_string(index=False, float_format=lambda v: f"{v:,.3g}"))
+    trained = new.loc[trained.index]
+    if len(trained) < len(new):
+        print(f"{len(new) - len(trained):,} new listings are missing a feature or a price and were left out")
+
+    if refreshed is None:
+        drifted = checks[checks["drifted"]]
+        pending_path = pending_history_path(history_path)
+        write_table(pd.concat([history, trained], ignore_index=True), pending_path)
+        print(f"Checks past the thresholds ({', '.join(drifted['check'] + ' ' + drifted['feature'])}): "
+              f"the model needs a full retrain on '{pending_path}'")
+        return pending_path
+    save_bundle(refreshed, bundle_dir)
+    append_table(trained, history_path)
+    print(f"Appended {len(trained):,} listings to '{history_path}'")
+    print(f"Refresh took {time.perf_counter() - start_time:,.2f}s")
+    return None
@@ -0,0 +1,301 @@
+"""Report stage: figures and result summaries for every other stage."""
+
+import functools
+
+import numpy as np
+import pandas as pd
+
+# When True every figure is skipped entirely, so batch runs never import matplotlib
+HEADLESS = False
+
+# Display settings for the per-family comparison figures and MAE percentages
+FAMILY_REPORTS = {
+    "rf": {
+        "box_labels": ["Base RF", "Random Search RF", "Grid Search RF"],
+        "box_title": "Fold-wise MAE Distribution (Lower is Better)",
+        "box_color": "lightblue",
+        "best_title": "Best Random Forest",
+        "residual_color": "coral",
+        "mae_names": ["Base Random Forest",
+                      "Random Search Tuned Random Forest",
+                      "Grid Search Tuned Random Forest"],
+    },
+    "xgb": {
+        "box_labels": ["Untuned XGB", "Random Search XGB", "Grid Search XGB"],
+        "box_title": "Fold-wise MAE Distribution – XGBoost Models (Lower is Better)",
+        "box_color": "salmon",
+        "best_title": "Best XGBoost",
+        "residual_color": "orange",
+        "mae_names": ["XGBoost Stratified K-Fold (Untuned)",
+                      "Randomly Tuned XGBoost Stratified K-Fold",
+                      "Grid Tuned XGBoost Stratified K-Fold"],
+    },
+    "gbr": {
+        "box_labels": ["Untuned GBR", "Random Search GBR", "Grid Search GBR"],
+        "box_title": "Fold-wise MAE Distribution – Gradient Boosting Models (Lower is Better)",
+        "box_color": "orange",
+        "best_title": "Best Gradient Boosting",
+        "residual_color": "darkorange",
+        "mae_names": ["Gradient Boosting Regressor Stratified K-Fold (Untuned)",
+                      "Random Search Tuned Gradient Boosting Stratified K-Fold",
+                      "Grid Search Tuned Gradient Boosting Stratified K-Fold"],
+    },
+    "hgb": {
+        "box_labels": ["Untuned HGB", "Random Search HGB", "Grid Search HGB"],
+        "box_title": "Fold-wise MAE Distribution – Histogram Gradient Boosting Models (Lower is Better)",
+        "box_color": "khaki",
+        "best_title": "Best Histogram Gradient Boosting",
+        "residual_color": "goldenrod",
+        "mae_names": ["Histogram Gradient Boosting Stratified K-Fold (Untuned)",
+                      "Random Search Tuned Histogram Gradient Boosting Stratified K-Fold",
+                      "Grid Search Tuned Histogram Gradient Boosting Stratified K-Fold"],
+    },
+}
+
+VARIANTS = ["untuned", "random", "grid"]
+
+
+def set_headless(headless=True):
+    global HEADLESS
+    HEADLESS = headless
+
+
+def figure(plot_function):
+    # Skip the plot (and the matplotlib/seaborn imports) when running headless
+    @functools.wraps(plot_function)
+    def wrapper(*args, **kwargs):
+        if HEADLESS:
+            return None
+        return plot_function(*args, **kwargs)
+    return wrapper
+
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    return plt, sns
+
+
+@figure
+def plot_all_clip_score_distributions(df):
+    plt, sns = _pyplot()
+    score_cols = [col for col in df.columns if col.endswith('_score')]
+    plt.figure(figsize=(12, 6))
+
+    for col in score_cols:
+        sns.kdeplot(df[col], fill=True, label=col.replace('_score', '').replace('_', ' ').title())
+
+    plt.title("Distribution of CLIP Visual Feature Scores")
+    plt.xlabel("Score")
+    plt.ylabel("Density")
+    plt.legend()
+    plt.tight_layout()
+    plt.show()
+
+
+# A plot to display missing values if any
+@figure
+def plot_missing_values(df):
+    plt, _ = _pyplot()
+    null_counts = df.isnull().sum()
+    null_counts = null_counts[null_counts > 0]
+
+    if null_counts.empty:
+        print("No missing values found.")
+    else:
+        plt.figure(figsize=(8, 4))
+        bars = plt.barh(null_counts.index, null_counts.values, color='orange')
+        for bar in bars:
+            plt.text(bar.get_width() + 0.5, bar.get_y() + bar.get_height()/2,
+                     f'{int(bar.get_width())}', va='center')
+        plt.title(f"Missing Values Per Column (Out of {len(df):,} rows)")
+        plt.xlabel("Missing Count")
+        plt.tight_layout()
+        plt.show()
+
+
+@figure
+def plot_outlier_boxplots(df, features, title):
+    plt, sns = _pyplot()
+    plt.figure(figsize=(14, 8))
+    for i, feature in enumerate(features, 1):
+        plt.subplot(2, 2, i)
+        sns.boxplot(x=df[feature], color='skyblue')
+        plt.title(f'Boxplot of {feature}')
+        plt.tight_layout()
+
+    plt.suptitle(title, fontsize=16, y=1.02)
+    plt.show()
+
+
+@figure
+def plot_price_violin(original_df, capped_df, price_column="price"):
+    plt, sns = _pyplot()
+
+    # Create a combined DataFrame for comparison
+    df_viz = pd.DataFrame({
+        "Original Price": original_df[price_column].astype(float),
+        "Capped Price": capped_df[price_column]
+    })
+
+    # Melt for Seaborn
+    df_melted = df_viz.melt(var_name="Stage", value_name="Price")
+
+    # Plot
+    plt.figure(figsize=(8, 5))
+    sns.violinplot(x="Stage", y="Price", data=df_melted, palette=["red", "green"])
+    plt.title("Price Distribution Before and After Capping")
+    plt.ylabel("Price")
+    plt.xlabel("")
+    plt.tight_layout()
+    plt.show()
+
+
+@figure
+def plot_correlation_heatmap(df):
+    plt, sns = _pyplot()
+    plt.figure(figsize=(14, 10))
+    sns.heatmap(
+        df.select_dtypes(include=['number']).corr(),  # Only numeric features
+        annot=True,
+        cmap='coolwarm',
+        fmt=".2f",
+        linewidths=0.5,
+        cbar_kws={"shrink": 0.8}
+    )
+    plt.title("Correlation Heatmap of Numeric Features", fontsize=16)
+    plt.xticks(rotation=45, ha='right')
+    plt.yticks(rotation=0)
+    plt.tight_layout()
+    plt.show()
+
+
+@figure
+def plot_mae_boxplot(mae_data, labels, title, color):
+    plt, _ = _pyplot()
+    plt.figure(figsize=(10, 6))
+    plt.boxplot(mae_data, labels=labels, patch_artist=True,
+                boxprops=dict(facecolor=color),
+                medianprops=dict(color='black'))
+    plt.title(title, fontsize=14)
+    plt.ylabel("Mean Absolute Error")
+    plt.grid(True)
+    plt.tight_layout()
+    plt.show()
+
+
+@figure
+def plot_actual_vs_predicted(y, y_pred, title):
+    plt, sns = _pyplot()
+    plt.figure(figsize=(6, 6))
+    sns.scatterplot(x=y, y=y_pred, alpha=0.4)
+    plt.plot([y.min(), y.max()], [y.min(), y.max()], '--', color='black')
+    plt.xlabel("Actual Price")
+    plt.ylabel("Predicted Price")
+    plt.title(f"Actual vs Predicted Prices – {title}")
+    plt.tight_layout()
+    plt.show()
+
+
+@figure
+def plot_prediction_error(y, y_pred, title, color='coral'):
+    plt, sns = _pyplot()
+    residuals = y - y_pred
+    plt.figure(figsize=(8, 5))
+    sns.histplot(residuals, bins=30, kde=True, color=color)
+    plt.axvline(0, color='black', linestyle='--')
+    plt.title(f"Residual Distribution – {title}")
+    plt.xlabel("Prediction Error (Actual - Predicted)")
+    plt.ylabel("Frequency")
+    plt.tight_layout()
+    plt.show()
+
+
+# Function to calculate and print percentage MAE/price for each model
+def print_mae_percentage(mae, model_name, mean_price):
+    percentage_mae = (mae / mean_price) * 100
+    print(f"{model_name} MAE Percentage: {percentage_mae:.2f}%")
+
+
+def report_family(family, results, y):
+    settings = FAMILY_REPORTS[family]
+
+    # Fold-wise MAE of the untuned, random search and grid search variants
+    mae_data = [results[family][variant]["mae"] for variant in VARIANTS]
+    plot_mae_boxplot(mae_data, settings["box_labels"], settings["box_title"], settings["box_color"])
+
+    # Diagnostics for the grid search tuned model, from its cached out-of-fold predictions
+    y_pred = results[family]["grid"]["oof_pred"]
+    plot_actual_vs_predicted(y, y_pred, settings["best_title"])
+    plot_prediction_error(y, y_pred, settings["best_title"], color=settings["residual_color"])
+
+    # Calculate the mean price
+    mean_price = np.mean(y)
+    print(f"Mean Price: ${mean_price:,.2f}")
+    for variant, name in zip(VARIANTS, settings["mae_names"]):
+        print_mae_percentage(np.mean(results[family][variant]["mae"]), name, mean_price)
+
+
+def summarise_results(results, y):
+    # Calculate the mean price
+    mean_price = np.mean(y)
+    print(f"Mean Price: ${mean_price:,.2f}")
+
+    # Only the families that were run, in display order
+    families = [family for family in FAMILY_REPORTS if family in results]
+    for i, family in enumerate(families):
+        if i > 0:
+            print("------------------------------------------------------------------------")
+        for variant, name in zip(VARIANTS, FAMILY_REPORTS[family]["mae_names"]):
+            print_mae_percentage(np.mean(results[family][variant]["mae"]), name, mean_price)
+
+    results_summary = pd.DataFrame({
+        "Model": [label for family in families for label in FAMILY_REPORTS[family]["box_labels"]],
+        "Avg MAE": [results[family][variant]["mae"].mean()
+                    for family in families for variant in VARIANTS],
+        "R²": [results[family][variant]["r2"].mean()
+               for family in families for variant in VARIANTS],
+        "MAE %": [results[family][variant]["mae_pct"].mean()
+                  for family in families for variant in VARIANTS],
+    })
+    print(results_summary)
+    return results_summary
+
+
+def compare_final_models(results):
+    final_models = [("rf", "untuned", "Random Forest"), ("xgb", "grid", "XGBoost"),
+                    ("gbr", "grid", "Gradient Boosting"), ("hgb", "grid", "Histogram Gradient Boosting")]
+    final_models = [(family, variant, label) for family, variant, label in final_models if family in results]
+    plot_mae_boxplot([results[family][variant]["mae"] for family, variant, _ in final_models],
+                     [label for _, _, label in final_models],
+                     "MAE Comparison of Final Tuned Models", "red")
+
+
+def compare_engines(trained, results, baseline="gbr", challenger="hgb"):
+    # Search time and cross-validated MAE of two families variant by variant, e.g. the
+    # exact and histogram gradient boosting engines
+    rows = []
+    for variant in VARIANTS:
+        times = [trained[family][variant]["search_seconds"] for family in (baseline, challenger)]
+        maes = [np.mean(results[family][variant]["mae"]) for family in (baseline, challenger)]
+        rows.append({
+            "variant": variant,
+            f"{baseline} search (s)": times[0],
+            f"{challenger} search (s)": times[1],
+            "speedup": times[0] / times[1] if times[0] is not None else None,
+            f"{baseline} MAE": maes[0],
+            f"{challenger} MAE": maes[1],
+        })
+    comparison = pd.DataFrame(rows)
+    print(comparison.to_string(index=False, float_format=lambda v: f"{v:,.2f}", na_rep="-"))
+    return comparison
+
+
+def run(results, y):
+    for family in FAMILY_REPORTS:
+        if family in results:
+            report_family(family, results, y)
+
+    results_summary = summarise_results(results, y)
+    compare_final_models(results)
+    return results_summary
@@ -0,0 +1,305 @@
+"""Online pricing service: one resident CLIP encoder and model, with concurrent requests micro-batched."""
+
+import asyncio
+import base64
+import binascii
+import io
+import json
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from . import preprocess
+from .bundle import PricePredictor
+
+STRUCTURED_FIELDS = ["city", "num_bedrooms", "num_bathrooms", "square_feet"]
+
+# Requests arriving within MAX_WAIT_MS of the first one share a batch, up to MAX_BATCH_SIZE
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 5.0
+
+# Recent latencies kept for the percentiles in /metrics
+LATENCY_WINDOW = 10_000
+
+# Largest request body read, enough for a listing with a base64 photo of several MB
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class LatencyStats:
+    # Request count, p50/p99 over a sliding window and throughput since start-up
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def snapshot(self):
+        latencies_ms = np.array(self.latencies) * 1000
+        uptime = time.perf_counter() - self.started
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None,
+            "p99_ms": float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else None,
+            "throughput_rps": self.count / uptime if uptime > 0 else 0.0,
+            "uptime_s": uptime,
+        }
+
+
+class MicroBatcher:
+    # Collects concurrent submissions into one call of batch_function, which runs in a
+    # worker thread so the event loop keeps accepting requests while the model is busy.
+    # batch_function takes a list of items and returns one result (or exception) per item.
+    def __init__(self, batch_function, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            self.batch_sizes.append(len(items))
+            try:
+                results = await asyncio.to_thread(self.batch_function, items)
+            except Exception as e:
+                results = [e] * len(items)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def mean_batch_size(self):
+        return float(np.mean(self.batch_sizes)) if self.batch_sizes else None
+
+
+class PricingService:
+    # Holds the bundle's model and preprocessing, and the CLIP encoder and prompt
+    # embeddings for the checkpoint the bundle was trained with
+    def __init__(self, bundle_path, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, device=None,
+                 backend="native", clip_backend="torch"):
+        import torch
+        from PIL import Image
+
+        from .extract import ClipEncoder, PromptBank
+
+        self._torch = torch
+        self._image_module = Image
+        self.predictor = PricePredictor(bundle_path, backend=backend)
+        clip = self.predictor.bundle["clip"]
+        self.encoder = ClipEncoder(clip["model_name"], clip["pretrained"], device=device, backend=clip_backend)
+        self.prompt_bank = PromptBank(clip["prompts"], self.encoder)
+
+        self.image_batcher = MicroBatcher(self._score_images, max_batch_size, max_wait_ms)
+        self.price_batcher = MicroBatcher(self._predict_prices, max_batch_size, max_wait_ms)
+        self.stats = LatencyStats()
+
+    def _score_images(self, images):
+        # Decode each image separately so one bad upload only fails its own request
+        results = [None] * len(images)
+        tensors, positions = [], []
+        for i, data in enumerate(images):
+            try:
+                image = self._image_module.open(io.BytesIO(data)).convert("RGB")
+                tensors.append(self.encoder.preprocess(image))
+                positions.append(i)
+            except Exception as e:
+                results[i] = ValueError(f"could not decode image: {type(e).__name__}: {e}")
+
+        if tensors:
+            image_features = self.encoder.encode_images(self._torch.stack(tensors))
+            for i, scores in zip(positions, self.prompt_bank.score(image_features)):
+                results[i] = scores
+        return results
+
+    def _predict_prices(self, rows):
+        # As in PricePredictor.predict, rows with a missing or unparseable feature fail on
+        # their own (a NaN city_code is a rare or unseen city, not a missing value)
+        features = self.predictor.preprocessing.transform_frame(pd.DataFrame(rows))
+        missing = features.drop(columns=[preprocess.CITY_CODE_FEATURE], errors="ignore").isna()
+        valid = ~missing.any(axis=1).to_numpy()
+        results = [ValueError(f"could not parse {', '.join(missing.columns[row])}")
+                   for row in missing.to_numpy()]
+        if valid.any():
+            predictions = self.predictor.predict_features(features[valid])
+            for i, price in zip(np.flatnonzero(valid), predictions):
+                results[i] = float(price) if np.isfinite(price) else ValueError("could not price listing")
+        return results
+
+    async def start(self):
+        self.image_batcher.start()
+        self.price_batcher.start()
+
+    async def stop(self):
+        await self.image_batcher.stop()
+        await self.price_batcher.stop()
+
+    async def price(self, listing):
+        # A listing has the structured fields plus either a base64 "image" or
+        # precomputed CLIP score columns
+        missing = [field for field in STRUCTURED_FIELDS if field not in listing]
+        if missing:
+            raise ValueError(f"missing fields: {', '.join(missing)}")
+
+        row = {field: listing[field] for field in STRUCTURED_FIELDS}
+        if all(col in listing for col in preprocess.SCORE_FEATURES):
+            # Parsed like the structured fields, so null or text scores fail with a 400
+            scores = preprocess._to_float(pd.Series([listing[col] for col in preprocess.SCORE_FEATURES],
+                                                    index=preprocess.SCORE_FEATURES, dtype=object))
+            if scores.isna().any():
+                raise ValueError(f"could not parse {', '.join(scores.index[scores.isna()])}")
+            scores = scores.to_dict()
+        elif "image" in listing:
+            try:
+                image_bytes = base64.b64decode(listing["image"], validate=True)
+            except (binascii.Error, TypeError) as e:
+                raise ValueError(f"image is not valid base64: {e}") from None
+            scores = await self.image_batcher.submit(image_bytes)
+        else:
+            raise ValueError("send either an image or every CLIP score column")
+
+        row.update(scores)
+        price = await self.price_batcher.submit(row)
+        return {"predicted_price": price,
+                "scores": {col: row[col] for col in preprocess.SCORE_FEATURES}}
+
+    def metrics(self):
+        return {
+            **self.stats.snapshot(),
+            "mean_image_batch": self.image_batcher.mean_batch_size(),
+            "mean_price_batch": self.price_batcher.mean_batch_size(),
+            "model": {key: self.predictor.bundle[key] for key in ("family", "variant", "created_at")},
+        }
+
+    async def handle(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/metrics":
+            return 200, self.metrics()
+        if path != "/predict":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        start_time = time.perf_counter()
+        try:
+            listing = json.loads(body)
+            if not isinstance(listing, dict):
+                raise ValueError("expected a JSON object")
+            response = await self.price(listing)
+        except ValueError as e:
+            self.stats.errors += 1
+            return 400, {"error": str(e)}
+        except Exception as e:
+            self.stats.errors += 1
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+        latency = time.perf_counter() - start_time
+        self.stats.record(latency)
+        response["latency_ms"] = latency * 1000
+        return 200, response
+
+
+async def _handle_connection(service, reader, writer):
+    # Minimal HTTP/1.1 with keep-alive, enough for JSON requests from curl or any client
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            except ValueError:
+                break
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            # A body that can't be framed or is over the cap is answered without being read,
+            # and the connection is closed as the rest of the stream can't be trusted
+            length = headers.get("content-length", "0").strip() or "0"
+            if not length.isdigit():
+                status, payload, keep_alive = 400, {"error": f"invalid Content-Length {length!r}"}, False
+            elif int(length) > MAX_BODY_BYTES:
+                status, payload, keep_alive = 413, {"error": f"body over {MAX_BODY_BYTES:,} bytes"}, False
+            else:
+                body = await reader.readexactly(int(length))
+                status, payload = await service.handle(method.upper(), path.split("?", 1)[0], body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+            data = json.dumps(payload).encode()
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(bundle_path, host="127.0.0.1", port=8000, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                backend="native", clip_backend="torch"):
+    start_time = time.perf_counter()
+    service = PricingService(bundle_path, max_batch_size, max_wait_ms, backend=backend, clip_backend=clip_backend)
+    await service.start()
+    print(f"Loaded model bundle and CLIP encoder in {time.perf_counter() - start_time:,.1f}s")
+
+    server = await asyncio.start_server(lambda r, w: _handle_connection(service, r, w), host, port)
+    print(f"Pricing service listening on http://{host}:{port} (POST /predict, GET /metrics)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
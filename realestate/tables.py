@@ -0,0 +1,110 @@
+"""Intermediate tables: Parquet files keyed on property_id, read back with column projection."""
+
+import os
+import shutil
+import time
+
+import pandas as pd
+
+
+def parts_dir(path):
+    # Rows appended to a Parquet table after it was written, one file per append
+    root, _ = os.path.splitext(path)
+    return f"{root}.parts"
+
+
+def table_files(path):
+    directory = parts_dir(path)
+    if not os.path.isdir(directory):
+        return [path]
+    parts = sorted(part for part in os.listdir(directory) if part.endswith(".parquet"))
+    return [path] + [os.path.join(directory, part) for part in parts]
+
+
+def write_table(df, path):
+    # Parquet keeps the dtypes (int32 ids, float32 scores, categorical city);
+    # a .csv path is still written as CSV. The whole table replaces any appended parts.
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    shutil.rmtree(parts_dir(path), ignore_errors=True)
+
+
+def append_table(df, path):
+    # Adds df's rows as a new part next to the table, cast to the table's schema, so an
+    # append costs time in proportion to df rather than to the table
+    if not os.path.exists(path):
+        write_table(df, path)
+        return
+    if path.endswith(".csv"):
+        df.to_csv(path, mode="a", header=False, index=False)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(path)
+    df = df.reindex(columns=schema.names)
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            df[field.name] = df[field.name].astype("category")
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    directory = parts_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    part_path = os.path.join(directory, f"part-{len(table_files(path)) - 1:05d}.parquet")
+    pq.write_table(table, part_path + ".tmp")
+    os.replace(part_path + ".tmp", part_path)
+
+
+def replace_table(source, path):
+    # Moves a table written elsewhere over path, dropping path's appended parts
+    os.replace(source, path)
+    shutil.rmtree(parts_dir(path), ignore_errors=True)
+
+
+def read_table(path, columns=None):
+    # Only the requested columns are read, from the table and any parts appended to it.
+    # The files are memory-mapped and converted without keeping a second copy of the
+    # Arrow buffers.
+    if path.endswith(".csv"):
+        return pd.read_csv(path, usecols=columns)
+    import pyarrow.parquet as pq
+
+    files = table_files(path)
+    table = pq.read_table(files if len(files) > 1 else path, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def benchmark_storage(df, directory=".", columns=None, repeats=3):
+    # Write and read time and file size of df as CSV and as Parquet, plus a Parquet read
+    # of just `columns` when given
+    rows = []
+    cases = [("csv", ".csv", None), ("parquet", ".parquet", None)]
+    if columns is not None:
+        cases.append((f"parquet, {len(columns)} columns", ".parquet", columns))
+
+    for name, suffix, read_columns in cases:
+        path = os.path.join(directory, f"_storage_benchmark{suffix}")
+        write_times, read_times = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            write_table(df, path)
+            write_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            read_table(path, columns=read_columns)
+            read_times.append(time.perf_counter() - start)
+
+        rows.append({"format": name, "write (ms)": min(write_times) * 1000,
+                     "read (ms)": min(read_times) * 1000, "file size (MB)": os.path.getsize(path) / 1e6})
+        os.remove(path)
+
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False, float_format=lambda v: f"{v:,.2f}"))
+    return results
@@ -0,0 +1,385 @@
+"""Training stage: untuned baselines plus random and grid search for each model family."""
+
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
+from sklearn.base import clone
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import (GridSearchCV, HalvingGridSearchCV, HalvingRandomSearchCV,
+                                     ParameterGrid, ParameterSampler, RandomizedSearchCV, train_test_split)
+from xgboost import XGBRegressor
+
+from .experiment import fit_xgboost_fold
+
+
+class EarlyStoppingXGBRegressor(XGBRegressor):
+    # Holds out part of each training fold as an early-stopping validation set, so
+    # n_estimators becomes an upper bound and poor configurations stop adding trees early
+    def __init__(self, *, validation_fraction=0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.validation_fraction = validation_fraction
+
+    def fit(self, X, y, **fit_params):
+        X_train, X_val, y_train, y_val = train_test_split(
+            X, y, test_size=self.validation_fraction, random_state=self.random_state)
+        return super().fit(X_train, y_train, eval_set=[(X_val, y_val)], verbose=False, **fit_params)
+
+
+# Each family has an untuned baseline, a base estimator for the searches, a random
+# search space and a narrower grid. "city" says how the family takes the city feature,
+# and "size_param" names the ensemble size parameter.
+MODEL_FAMILIES = {
+    "rf": {
+        "name": "Random Forest",
+        "untuned": lambda: RandomForestRegressor(n_estimators=100, random_state=42),
+        "search_base": lambda: RandomForestRegressor(random_state=42),
+        "random_grid": {
+            'n_estimators': [100, 150, 200],
+            'max_depth': [10, 15, None],
+            'min_samples_split': [2, 5, 10],
+            'min_samples_leaf': [1, 2, 4],
+            'max_features': ['sqrt', 0.8, 1.0]
+        },
+        "grid": {
+            'n_estimators': [150, 200],
+            'max_depth': [10, None],
+            'min_samples_split': [2, 5],
+            'min_samples_leaf': [1, 2, 3],
+            'max_features': ['sqrt', 0.8, 1]
+        },
+    },
+    "xgb": {
+        "name": "XGBoost",
+        "untuned": lambda: XGBRegressor(
+            n_estimators=300,
+            learning_rate=0.1,
+            max_depth=6,
+            subsample=0.8,
+            colsample_bytree=0.8,
+            random_state=0
+        ),
+        "search_base": lambda: XGBRegressor(objective='reg:squarederror', random_state=42),
+        "halving_base": lambda: EarlyStoppingXGBRegressor(objective='reg:squarederror', random_state=42,
+                                                          early_stopping_rounds=30),
+        "random_grid": {
+            'n_estimators': [100, 200, 300, 400],
+            'learning_rate': [0.01, 0.03, 0.05, 0.1],
+            'max_depth': [4, 5, 6, 8],
+            'subsample': [0.6, 0.8, 1.0],
+            'colsample_bytree': [0.6, 0.8, 1.0],
+            'reg_alpha': [0, 0.1, 1],
+            'reg_lambda': [1, 1.5, 2]
+        },
+        "grid": {
+            'n_estimators': [400, 450, 500],
+            'learning_rate': [0.08, 0.1],
+            'max_depth': [7, 8, 9],
+            'subsample': [0.5, 0.6],
+            'colsample_bytree': [0.8, 0.7],
+            'reg_alpha': [0.1, 1],
+            'reg_lambda': [0.8, 2]
+        },
+    },
+    "gbr": {
+        "name": "Gradient Boosting",
+        "untuned": lambda: GradientBoostingRegressor(
+            n_estimators=300,
+            learning_rate=0.05,
+            max_depth=5,
+            subsample=0.8,
+            random_state=42
+        ),
+        "search_base": lambda: GradientBoostingRegressor(random_state=42),
+        "random_grid": {
+            'n_estimators': [100, 200, 300, 400],
+            'learning_rate': [0.01, 0.03, 0.05, 0.1],
+            'max_depth': [3, 4, 5, 6],
+            'subsample': [0.6, 0.8, 1.0],
+            'min_samples_split': [2, 5, 10],
+            'min_samples_leaf': [1, 2, 4]
+        },
+        "grid": {
+            'n_estimators': [350, 400, 450],
+            'learning_rate': [0.1, 0.2],
+            'max_depth': [5, 6],
+            'subsample': [0.8, 1.0],
+            'min_samples_split': [8, 10, 12],
+            'min_samples_leaf': [1, 2]
+        },
+    },
+    # Histogram-binned gradient boosting as an alternative engine for the GBR stage: the
+    # same search spaces with n_estimators as max_iter, depth-limited trees as in
+    # GradientBoostingRegressor, and per-split feature sampling and L2 regularisation in
+    # place of row subsampling and min_samples_split, which it does not have. City is a
+    # native categorical feature instead of the target encoding.
+    "hgb": {
+        "name": "Histogram Gradient Boosting",
+        "city": "categorical",
+        "size_param": "max_iter",
+        "untuned": lambda: HistGradientBoostingRegressor(
+            max_iter=300,
+            learning_rate=0.05,
+            max_depth=5,
+            max_leaf_nodes=None,
+            early_stopping=False,
+            random_state=42
+        ),
+        "search_base": lambda: HistGradientBoostingRegressor(max_leaf_nodes=None, early_stopping=False,
+                                                             random_state=42),
+        "random_grid": {
+            'max_iter': [100, 200, 300, 400],
+            'learning_rate': [0.01, 0.03, 0.05, 0.1],
+            'max_depth': [3, 4, 5, 6],
+            'max_features': [0.6, 0.8, 1.0],
+            'l2_regularization': [0, 0.1, 1],
+            'min_samples_leaf': [1, 2, 4]
+        },
+        "grid": {
+            'max_iter': [350, 400, 450],
+            'learning_rate': [0.1, 0.2],
+            'max_depth': [5, 6],
+            'max_features': [0.8, 1.0],
+            'l2_regularization': [0, 0.1, 1],
+            'min_samples_leaf': [1, 2]
+        },
+    },
+}
+
+# The families run by default; hgb replaces or joins gbr with run(gbr_engine=...)
+DEFAULT_FAMILIES = ["rf", "xgb", "gbr"]
+GBR_ENGINES = {"exact": ["gbr"], "hist": ["hgb"], "both": ["gbr", "hgb"]}
+
+
+def family_context(family, context):
+    # The view of the shared experiment context that a family trains and is evaluated on
+    if MODEL_FAMILIES[family].get("city") == "categorical":
+        return context.categorical
+    return context
+
+
+def base_estimator(family, key, context):
+    # A fresh estimator from the family spec; native categorical models are told which
+    # column holds the city
+    estimator = MODEL_FAMILIES[family][key]()
+    if MODEL_FAMILIES[family].get("city") == "categorical":
+        estimator.set_params(categorical_features=[context.city_column])
+    return estimator
+
+
+def fit_search(search, context):
+    # Search over the context's shared folds, then refit the best candidate on the full
+    # data as refit=True would
+    X_cv, y_cv, cv = context.search_data
+    search.set_params(cv=cv, refit=False).fit(X_cv, y_cv)
+    search.best_estimator_ = clone(search.estimator).set_params(**search.best_params_).fit(context.X, context.y)
+    return search
+
+
+def random_search(family, context):
+    spec = MODEL_FAMILIES[family]
+    search = RandomizedSearchCV(
+        estimator=base_estimator(family, "search_base", context),
+        param_distributions=spec["random_grid"],
+        n_iter=50,
+        verbose=1,
+        random_state=42,
+        n_jobs=-1,
+        scoring='neg_mean_absolute_error'
+    )
+    return fit_search(search, context)
+
+
+def grid_search(family, context):
+    spec = MODEL_FAMILIES[family]
+    search = GridSearchCV(
+        estimator=base_estimator(family, "search_base", context),
+        param_grid=spec["grid"],
+        scoring='neg_mean_absolute_error',
+        verbose=1,
+        n_jobs=-1
+    )
+    return fit_search(search, context)
+
+
+def halving_search(family, context, variant):
+    # Successive halving over the same search spaces: every candidate starts on a small
+    # sample of each training fold and only the best third moves on to three times the
+    # data, until the survivors are trained on the full folds. XGBoost candidates also
+    # stop adding trees once a held-out validation split stops improving.
+    spec = MODEL_FAMILIES[family]
+    estimator = base_estimator(family, "halving_base" if "halving_base" in spec else "search_base", context)
+    common = dict(estimator=estimator, factor=3, resource='n_samples', min_resources='exhaust',
+                  scoring='neg_mean_absolute_error', verbose=1, n_jobs=-1)
+
+    if variant == "random":
+        search = HalvingRandomSearchCV(param_distributions=spec["random_grid"], n_candidates=50,
+                                       random_state=42, **common)
+        n_full_candidates = 50
+    else:
+        search = HalvingGridSearchCV(param_grid=spec["grid"], **common)
+        n_full_candidates = len(ParameterGrid(spec["grid"]))
+
+    # Halving re-splits at every iteration, which the context's list of folds allows
+    fit_search(search, context)
+    print_search_savings(search, n_full_candidates, context.n_splits)
+    return search
+
+
+def print_search_savings(search, n_full_candidates, n_splits):
+    # Compare the fits actually run with an exhaustive search, estimating each full fit
+    # from the candidates that reached the full training folds
+    results = search.cv_results_
+    fit_seconds = np.sum(results["mean_fit_time"]) * n_splits
+    full_resources = results["n_resources"] == np.max(results["n_resources"])
+    full_fit_seconds = np.mean(results["mean_fit_time"][full_resources]) * n_full_candidates * n_splits
+    n_fits = len(results["params"]) * n_splits
+
+    print(f" Successive halving: {n_fits:,} fits in {fit_seconds:,.1f}s of fit time vs "
+          f"{n_full_candidates * n_splits:,} full fits (~{full_fit_seconds:,.1f}s) exhaustively, "
+          f"~{full_fit_seconds - fit_seconds:,.1f}s saved")
+
+
+def _staged_predictions(estimator, sizes, X_train, y_train, X_test):
+    # Predictions for every ensemble size from a single model grown to the largest size.
+    # A model with k trees is exactly the first k trees of the larger one, because each
+    # library draws its per-tree randomness in order.
+    sizes = sorted(sizes)
+    if isinstance(estimator, (GradientBoostingRegressor, HistGradientBoostingRegressor)):
+        size_param = "max_iter" if isinstance(estimator, HistGradientBoostingRegressor) else "n_estimators"
+        model = clone(estimator).set_params(**{size_param: sizes[-1]}).fit(X_train, y_train)
+        staged = list(model.staged_predict(X_test))
+        return {k: staged[k - 1] for k in sizes}
+
+    # Random forests grow the same ensemble incrementally with warm_start
+    model = clone(estimator).set_params(warm_start=True)
+    predictions = {}
+    for k in sizes:
+        model.set_params(n_estimators=k).fit(X_train, y_train)
+        predictions[k] = model.predict(X_test)
+    return predictions
+
+
+def _xgboost_staged_predictions(estimator, sizes, context, fold):
+    # The XGBoost version, trained on the fold's cached QuantileDMatrix
+    booster, dtest = fit_xgboost_fold(clone(estimator).set_params(n_estimators=max(sizes)), context, fold)
+    return {k: booster.predict(dtest, iteration_range=(0, k)) for k in sizes}
+
+
+def _other_params(params, size_param='n_estimators'):
+    # Hashable key of every parameter except the ensemble size (keys are unique, so
+    # sorting never has to compare the values)
+    return tuple(sorted((key, value) for key, value in params.items() if key != size_param))
+
+
+class NEstimatorsSweepSearchCV:
+    # Stands in for GridSearchCV / RandomizedSearchCV (neg MAE scoring, refit=True) on an
+    # ExperimentContext: fits one ensemble per fold for each combination of the other
+    # parameters, and scores every n_estimators value of that combination from it.
+    # Candidates, fold scores, ranking and best_params_ come out exactly as the original
+    # searches would give them. size_param names the ensemble size (max_iter for
+    # HistGradientBoostingRegressor).
+    def __init__(self, estimator, candidates, n_jobs=-1, size_param='n_estimators'):
+        self.estimator = estimator
+        self.candidates = list(candidates)
+        self.n_jobs = n_jobs
+        self.size_param = size_param
+
+    def fit(self, context):
+        n_splits = context.n_splits
+
+        # Group candidates that differ only in their ensemble size
+        groups = {}
+        for params in self.candidates:
+            groups.setdefault(_other_params(params, self.size_param), set()).add(params[self.size_param])
+
+        tasks = [(others, sorted(sizes), fold) for others, sizes in groups.items() for fold in range(n_splits)]
+        if isinstance(self.estimator, XGBRegressor):
+            # Each XGBoost fit already uses every core, and the folds' matrices are shared
+            # within this process
+            fold_predictions = [
+                _xgboost_staged_predictions(clone(self.estimator).set_params(**dict(others)), sizes, context, fold)
+                for others, sizes, fold in tasks
+            ]
+        else:
+            fold_predictions = Parallel(n_jobs=self.n_jobs)(
+                delayed(_staged_predictions)(clone(self.estimator).set_params(**dict(others)), sizes,
+                                             *context.fold_data(fold)[:3])
+                for others, sizes, fold in tasks
+            )
+        scores = {}
+        for (others, _, fold), predictions in zip(tasks, fold_predictions):
+            y_test = context.fold_data(fold)[3]
+            for k, y_pred in predictions.items():
+                scores[(others, k, fold)] = -mean_absolute_error(y_test, y_pred)
+
+        split_scores = np.array([
+            [scores[(_other_params(params, self.size_param), params[self.size_param], fold)]
+             for fold in range(n_splits)]
+            for params in self.candidates
+        ])
+        mean_scores = split_scores.mean(axis=1)
+        self.cv_results_ = {
+            "params": self.candidates,
+            "mean_test_score": mean_scores,
+            "std_test_score": split_scores.std(axis=1),
+            "rank_test_score": rankdata(-mean_scores, method="min").astype(np.int32),
+            **{f"split{fold}_test_score": split_scores[:, fold] for fold in range(n_splits)},
+        }
+        self.best_index_ = int(self.cv_results_["rank_test_score"].argmin())
+        self.best_params_ = self.candidates[self.best_index_]
+        self.best_score_ = mean_scores[self.best_index_]
+
+        self.n_trees_built_ = sum(max(sizes) for _, sizes, _ in tasks)
+        self.n_trees_exhaustive_ = sum(params[self.size_param] for params in self.candidates) * n_splits
+        print(f" n_estimators sweep: built {self.n_trees_built_:,} trees instead of "
+              f"{self.n_trees_exhaustive_:,} ({len(tasks):,} fits instead of {len(self.candidates) * n_splits:,})")
+
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(context.X, context.y)
+        return self
+
+
+def warm_start_search(family, context, variant):
+    # Same candidates and folds as random_search / grid_search
+    spec = MODEL_FAMILIES[family]
+    if variant == "random":
+        candidates = ParameterSampler(spec["random_grid"], n_iter=50, random_state=42)
+    else:
+        candidates = ParameterGrid(spec["grid"])
+    search = NEstimatorsSweepSearchCV(base_estimator(family, "search_base", context), candidates,
+                                      size_param=spec.get("size_param", "n_estimators"))
+    return search.fit(context)
+
+
+def train_family(family, context, search_mode="exhaustive"):
+    # Search time (including the refit) is kept with each tuned model for comparing engines
+    spec = MODEL_FAMILIES[family]
+    context = family_context(family, context)
+    trained = {"untuned": {"model": base_estimator(family, "untuned", context), "best_params": None,
+                           "search_seconds": None}}
+
+    for variant, run_search in (("random", random_search), ("grid", grid_search)):
+        start_time = time.perf_counter()
+        if search_mode == "halving":
+            search = halving_search(family, context, variant)
+        elif search_mode == "warm_start":
+            search = warm_start_search(family, context, variant)
+        else:
+            search = run_search(family, context)
+        print(f"\n {variant.title()} Search {spec['name']} Best Hyperparameters:", search.best_params_)
+        trained[variant] = {"model": search.best_estimator_, "best_params": search.best_params_,
+                            "search_seconds": time.perf_counter() - start_time}
+
+    return trained
+
+
+def run(context, families=None, search_mode="exhaustive", gbr_engine="exact"):
+    # gbr_engine picks the gradient boosting stage when families is not given:
+    # "exact" (GradientBoostingRegressor), "hist" (HistGradientBoostingRegressor) or "both"
+    if families is None:
+        families = [name for family in DEFAULT_FAMILIES
+                    for name in (GBR_ENGINES[gbr_engine] if family == "gbr" else [family])]
+    return {family: train_family(family, context, search_mode) for family in families}